@@ -0,0 +1,216 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from itertools import combinations
+
+import numpy as np
+
+import PersistentHomology as ph
+
+# Benchmark of the persistent homology pipeline on synthetic filtrations.
+# Every generator takes a size and a seed and returns a SparseMatrix boundary
+# matrix together with its simplices dimension ranges (see computeBetti), with
+# the simplices sorted by dimension
+
+
+# Turn a list of simplices (sorted tuples of vertices, ordered by dimension and
+# closed under taking faces) into a boundary matrix and its dimension ranges
+def filtrationMatrix(simplices):
+  position = {s: j for j, s in enumerate(simplices)}
+  columns = [[position[f] for f in combinations(s, len(s)-1)] if len(s) > 1 else []
+             for s in simplices]
+
+  ranges = []
+  start = 0
+  for j in range(1, len(simplices)+1):
+    if j == len(simplices) or len(simplices[j]) != len(simplices[start]):
+      ranges.append((start, j-1))
+      start = j
+
+  return ph.SparseMatrix(columns), ranges
+
+# Flag complex of a random graph on size vertices (each edge present with
+# probability 0.3) up to dimension maxDim, in random order within each dimension
+def randomComplex(size, seed, probability=0.3, maxDim=3):
+  rng = random.Random(seed)
+  edges = [e for e in combinations(range(size), 2) if rng.random() < probability]
+  neighbors = [set() for v in range(size)]
+  for u, v in edges:
+    neighbors[u].add(v)
+
+  levels = [[(v,) for v in range(size)], edges]
+  for dim in range(2, maxDim+1):
+    levels.append([s + (w,) for s in levels[-1] for w in sorted(set.intersection(*(neighbors[v] for v in s)))])
+  for level in levels:
+    rng.shuffle(level)
+
+  return filtrationMatrix([s for level in levels if level for s in level])
+
+# Rips filtration of size random points in the unit cube up to dimension maxDim.
+# The simplices are taken dimension by dimension, each dimension sorted by
+# filtration value, so that the result has dimension ranges
+def ripsComplex(size, seed, maxDim=2, threshold=None):
+  points = np.random.default_rng(seed).random((size, 3))
+  if threshold is None:
+    # about a dozen neighbors per point
+    threshold = (12.0 / size) ** (1.0 / 3)
+  rips = ph.RipsFiltration(points, maxDim-1, threshold)
+
+  order = np.lexsort((rips.values, rips.dims))
+  simplices = [rips.decode(rips.keys[j], int(rips.dims[j])) for j in order]
+  return filtrationMatrix(simplices)
+
+# Triangulated torus: a size x size grid of squares, each cut into two triangles,
+# with opposite sides identified
+def torus(size, seed):
+  rng = random.Random(seed)
+  vertex = lambda i, j: (i % size) * size + (j % size)
+  triangles = []
+  for i in range(size):
+    for j in range(size):
+      triangles.append(tuple(sorted((vertex(i, j), vertex(i+1, j), vertex(i+1, j+1)))))
+      triangles.append(tuple(sorted((vertex(i, j), vertex(i, j+1), vertex(i+1, j+1)))))
+
+  edges = sorted({e for t in triangles for e in combinations(t, 2)})
+  levels = [[(v,) for v in range(size*size)], edges, triangles]
+  for level in levels:
+    rng.shuffle(level)
+  return filtrationMatrix([s for level in levels for s in level])
+
+# Worst case for the reduction: size rows of dimension 0 and size columns of
+# dimension 1, each holding a random half of the rows. Reducing it is Gaussian
+# elimination of a dense random matrix, every column fills in completely
+def worstCaseFillIn(size, seed):
+  rng = random.Random(seed)
+  columns = [[] for row in range(size)]
+  columns += [[row for row in range(size) if rng.random() < 0.5] for col in range(size)]
+  return ph.SparseMatrix(columns), [(0, size-1), (size, 2*size-1)]
+
+GENERATORS = {"random": randomComplex, "rips": ripsComplex, "torus": torus, "fillin": worstCaseFillIn}
+
+# Generators that stop a Rips complex at its top dimension. Those simplices miss
+# the cofaces the full complex would have, so the Betti number of the top
+# dimension is not recorded
+TRUNCATED = {"rips"}
+
+# Reductions to compare, by name: keyword arguments of REDUCE
+REDUCTIONS = {
+  "dense": {"engine": "dense"},
+  "sparse": {"engine": "sparse"},
+  "bitset": {"engine": "bitset"},
+  "twist": {"engine": "sparse", "clearing": True},
+  "cohomology": {"engine": "sparse", "clearing": True, "cohomology": True},
+}
+
+
+# Run stage once to time it and once under tracemalloc for its peak memory.
+# Anything it prints is swallowed. Returns the result of the timed run
+# tracemalloc only sees this process, so the peak of a reduction with workers > 1
+# leaves out the worker processes; its record says so with "peakBytesScope"
+def measure(stage, record):
+  with contextlib.redirect_stdout(io.StringIO()):
+    start = time.perf_counter()
+    result = stage()
+    record["seconds"] = time.perf_counter() - start
+
+    tracemalloc.start()
+    stage()
+    record["peakBytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  return result
+
+# Time every stage of every reduction on one generated filtration. The reductions
+# other than dense are run with each number of workers (the chunk algorithm for
+# more than one). Their column additions are counted as well, in all and in the
+# local phase of the chunk algorithm, to show that the work does not grow with
+# the workers and how much of it the workers share, and their reduce stage gets
+# its speedup over the run with one worker
+def benchmark(generator, size, seed, reductions, workers=(1,)):
+  records = []
+  base = {"generator": generator, "size": size, "seed": seed}
+
+  record = dict(base, stage="generate")
+  D, simplices = measure(lambda: GENERATORS[generator](size, seed), record)
+  record["simplices"] = len(D.columns)
+  record["nonzeros"] = sum(len(col) for col in D.columns)
+  records.append(record)
+
+  runs = [(name, w) for name in reductions for w in ([1] if name == "dense" else sorted(workers))]
+  single = {}
+  for name, w in runs:
+    options = dict(REDUCTIONS[name], workers=w)
+    matrix = D.toDense() if name == "dense" else D
+    base = {"generator": generator, "size": size, "seed": seed, "workers": w}
+
+    record = dict(base, stage="reduce", reduction=name)
+    R = measure(lambda: ph.REDUCE(matrix, simplices=simplices, **options), record)
+    record["peakBytesScope"] = "parent process only" if w > 1 else "all"
+    record["cleared"] = getattr(R, "cleared", 0)
+    if w == 1:
+      single[name] = record["seconds"]
+    if name in single:
+      record["speedup"] = single[name] / record["seconds"]
+    if name != "dense":
+      report = ph.ReductionReport()
+      ph.REDUCE(matrix, simplices=simplices, report=report, **options)
+      record["columnOperations"] = sum(report.columnOperations.values())
+      record["localOperations"] = sum(report.localOperations.values())
+    records.append(record)
+
+    record = dict(base, stage="computeBetti", reduction=name)
+    betti = measure(lambda: ph.computeBetti(R, simplices), record)[2]
+    record["betti"] = betti[:-1] if generator in TRUNCATED else betti
+    records.append(record)
+
+    record = dict(base, stage="persistence", reduction=name)
+    measure(lambda: [ph.persistence(p, R, simplices) for p in range(len(simplices))], record)
+    records.append(record)
+
+    record = dict(base, stage="diagrams", reduction=name)
+    measure(lambda: ph.diagrams(R, simplices), record)
+    records.append(record)
+
+  return records
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the persistent homology pipeline")
+  parser.add_argument("--generators", nargs="+", default=sorted(GENERATORS), choices=sorted(GENERATORS))
+  parser.add_argument("--sizes", nargs="+", type=int, default=[10, 20, 40])
+  parser.add_argument("--reductions", nargs="+", default=["sparse", "bitset", "twist", "cohomology"],
+                      choices=sorted(REDUCTIONS))
+  parser.add_argument("--workers", nargs="+", type=int, default=[1], help="worker counts of the chunk algorithm")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+  args = parser.parse_args()
+
+  records = []
+  for generator in args.generators:
+    for size in args.sizes:
+      for record in benchmark(generator, size, args.seed, args.reductions, args.workers):
+        records.append(record)
+        print(generator, size, record["stage"], record.get("reduction", ""), record.get("workers", ""),
+              "%.4fs" % record["seconds"], "%d bytes" % record["peakBytes"],
+              "(parent process only)" if record.get("peakBytesScope") == "parent process only" else "",
+              file=sys.stderr)
+
+  results = {
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "platform": platform.platform(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "records": records,
+  }
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+  main()
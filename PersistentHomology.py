@@ -1,7 +1,18 @@
-import matplotlib.pyplot as plt
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import hashlib
+from math import comb
+import os
+import time
+import numpy as np
 
 # Helper function to print a matrix neatly
 def printMatrix(m):
+  # sparse matrices are expanded so they print the same way
+  if hasattr(m, "toDense"):
+    m = m.toDense()
   for row in range(len(m)):
     print(m[row])
 
@@ -9,6 +20,10 @@ def printMatrix(m):
 # in the boundary matrix, None if it's a zero column
 def getLows(matrix):
 
+  # sparse matrices keep their columns sorted, so the lowest one is the last entry
+  if hasattr(matrix, "getLows"):
+    return matrix.getLows()
+
   # initialize all lowest ones to None
   lows = [None]*len(matrix[0])
 
@@ -29,25 +44,631 @@ def equalLow(lows, j):
   # for each column j0 to the left of j
   for j0 in range(j):
     # if j0 is not a zero column and j0 has the same lowest one and j
-    if lows[j0] and lows[j0] == lows[j]:
+    if lows[j0] is not None and lows[j0] == lows[j]:
       return j0
   return None
 
-# Compute reduced matrix R from a boundary matrix
-def REDUCE(boundaryMatrix):
+# Column backends for SparseMatrix. A backend converts a column to and from the
+# sorted list of its rows, finds its lowest one and adds two columns over Z/2
+
+# Each column is the sorted list of the rows that hold a 1
+class SortedColumns(object):
+
+  @staticmethod
+  def fromRows(rows):
+    return sorted(rows)
+
+  @staticmethod
+  def toRows(col):
+    return col
+
+  @staticmethod
+  def low(col):
+    return col[-1] if col else None
+
+  @staticmethod
+  def size(col):
+    return len(col)
+
+  # rows present in both columns cancel out
+  @staticmethod
+  def add(a, b):
+    return sorted(set(a).symmetric_difference(b))
+
+# Each column is a Python int used as a bitset, bit r is set if row r holds a 1.
+# Adding two columns is a single XOR and the lowest one is the highest set bit.
+# This pays off for dense-ish columns, a column with a single one in row r
+# still costs r bits
+class BitColumns(object):
+
+  @staticmethod
+  def fromRows(rows):
+    col = 0
+    for row in rows:
+      col |= 1 << row
+    return col
+
+  @staticmethod
+  def toRows(col):
+    rows = []
+    # peel off the least significant set bit until nothing is left
+    while col:
+      bit = col & -col
+      rows.append(bit.bit_length() - 1)
+      col ^= bit
+    return rows
+
+  @staticmethod
+  def low(col):
+    return col.bit_length() - 1 if col else None
+
+  @staticmethod
+  def size(col):
+    return col.bit_count()
+
+  @staticmethod
+  def add(a, b):
+    return a ^ b
+
+# A boundary matrix stored column by column, in the representation of one of the
+# column backends above. Memory is proportional to the number of nonzero entries
+# (d+1 per d-simplex) instead of to the square of the number of simplices
+class SparseMatrix(object):
+
+  # columns are given as lists of the rows that hold a 1
+  def __init__(self, columns, numRows=None, backend=SortedColumns):
+    self.backend = backend
+    # copy the columns so the caller's lists are never modified by a reduction
+    self.columns = [backend.fromRows(col) for col in columns]
+    # boundary matrices are square unless told otherwise
+    self.numRows = len(self.columns) if numRows is None else numRows
+    # lowest one -> column, filled in by a reduction
+    self.pivots = {}
+    # True if this is the anti-transpose of a boundary matrix (see reduceCohomology)
+    self.antiTransposed = False
+
+  # build a sparse matrix from a dense list-of-lists boundary matrix
+  @classmethod
+  def fromDense(cls, matrix, backend=SortedColumns):
+    columns = [[] for col in range(len(matrix[0]))]
+    for row in range(len(matrix)):
+      for col, entry in enumerate(matrix[row]):
+        if entry == 1:
+          columns[col].append(row)
+    return cls(columns, len(matrix), backend)
+
+  # build a sparse matrix from any boundary matrix: a SparseMatrix is copied,
+  # an object with column(j) and len (RipsFiltration, MappedMatrix) is read
+  # column by column, anything else is a dense list-of-lists
+  @classmethod
+  def fromMatrix(cls, matrix, backend=SortedColumns):
+    if isinstance(matrix, SparseMatrix):
+      return matrix.copy(backend)
+    if hasattr(matrix, "column"):
+      return cls([matrix.column(j) for j in range(len(matrix))], len(matrix), backend)
+    return cls.fromDense(matrix, backend)
+
+  def __len__(self):
+    return len(self.columns)
+
+  # copy of this matrix, possibly stored with another backend
+  def copy(self, backend=None):
+    rows = [self.column(col) for col in range(len(self.columns))]
+    return SparseMatrix(rows, self.numRows, backend or self.backend)
+
+  # the sorted list of the rows of column col that hold a 1
+  def column(self, col):
+    return self.backend.toRows(self.columns[col])
+
+  # expand back into a dense list-of-lists matrix
+  def toDense(self):
+    matrix = [[0]*len(self.columns) for row in range(self.numRows)]
+    for col in range(len(self.columns)):
+      for row in self.column(col):
+        matrix[row][col] = 1
+    return matrix
+
+  # same result as getLows on the dense matrix, without looking at the zeroes
+  # For a reduced coboundary matrix the pairs are mapped back, so the result is
+  # the one getLows gives for the reduced boundary matrix
+  def getLows(self):
+    lows = [self.backend.low(col) for col in self.columns]
+    if not self.antiTransposed:
+      return lows
+
+    # a pair (row i, column j) of the anti-transpose is the pair
+    # (row n-1-j, column n-1-i) of the boundary matrix
+    n = len(lows)
+    boundaryLows = [None]*n
+    for j in range(n):
+      if lows[j] is not None:
+        boundaryLows[n-1-lows[j]] = n-1-j
+    return boundaryLows
+
+  # the anti-transpose (transpose along the anti-diagonal) of this square matrix:
+  # entry (i, j) moves to (n-1-j, n-1-i), so the columns become the coboundaries
+  # of the simplices in reverse filtration order
+  def antiTranspose(self):
+    n = len(self.columns)
+    columns = [[] for col in range(n)]
+    for j in range(n):
+      for i in self.column(j):
+        columns[n-1-i].append(n-1-j)
+    A = SparseMatrix(columns, n, self.backend)
+    A.antiTransposed = not self.antiTransposed
+    return A
+
+# A point of a persistence diagram returned by diagrams
+DIAGRAM_DTYPE = np.dtype([("birth", float), ("death", float), ("infinite", bool)])
+
+# Instrumentation of a reduction, filled in by the functions that accept a
+# report argument (REDUCE, computeBetti, persistence, diagrams...). For each
+# dimension it counts the columns reduced, the column additions (and among them
+# those of the local phase of the chunk algorithm) and the fill (number of
+# nonzero entries) of the nonzero reduced columns; it also adds up the time
+# spent looking up pivots and the wall time of each phase. When no report is
+# passed the reduction runs its uninstrumented loop
+class ReductionReport(object):
+
+  def __init__(self):
+    self.columns = {}
+    self.columnOperations = {}
+    self.localOperations = {}
+    self.nonzeroColumns = {}
+    self.totalFill = {}
+    self.maxFill = {}
+    self.cleared = 0
+    self.pivotLookupSeconds = 0.0
+    self.phaseSeconds = {}
+
+  # one more column of dimension dim reduced, with fill entries left
+  def addColumn(self, dim, fill):
+    self.columns[dim] = self.columns.get(dim, 0) + 1
+    if fill:
+      self.nonzeroColumns[dim] = self.nonzeroColumns.get(dim, 0) + 1
+      self.totalFill[dim] = self.totalFill.get(dim, 0) + fill
+      self.maxFill[dim] = max(self.maxFill.get(dim, 0), fill)
+
+  # count more column additions into a column of dimension dim, made in the
+  # local phase of the chunk algorithm if local
+  def addOperation(self, dim, count=1, local=False):
+    self.columnOperations[dim] = self.columnOperations.get(dim, 0) + count
+    if local:
+      self.localOperations[dim] = self.localOperations.get(dim, 0) + count
+
+  # context manager adding the wall time of its block to phase name
+  def phase(self, name):
+    return PhaseTimer(self, name)
+
+  # the report as plain dictionaries and numbers (ready for json.dump), with
+  # the statistics of each dimension under "dimensions"
+  def toDict(self):
+    dimensions = {}
+    for dim in sorted(self.columns, key=lambda d: -1 if d is None else d):
+      nonzero = self.nonzeroColumns.get(dim, 0)
+      dimensions[str(dim)] = {
+        "columns": self.columns[dim],
+        "columnOperations": self.columnOperations.get(dim, 0),
+        "localOperations": self.localOperations.get(dim, 0),
+        "maxFill": self.maxFill.get(dim, 0),
+        "averageFill": self.totalFill.get(dim, 0) / nonzero if nonzero else 0.0,
+      }
+    return {
+      "dimensions": dimensions,
+      "cleared": self.cleared,
+      "pivotLookupSeconds": self.pivotLookupSeconds,
+      "phaseSeconds": dict(self.phaseSeconds),
+    }
+
+# Times one phase for ReductionReport.phase
+class PhaseTimer(object):
+
+  def __init__(self, report, name):
+    self.report = report
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exception):
+    seconds = time.perf_counter() - self.start
+    self.report.phaseSeconds[self.name] = self.report.phaseSeconds.get(self.name, 0.0) + seconds
+    return False
+
+# report.phase(name), or a context manager doing nothing if there is no report
+def timed(report, name):
+  return nullcontext() if report is None else report.phase(name)
+
+# Dimension of each of the n columns, from simplices (see the comment before
+# computeBetti). Columns outside every range get dimension None
+def columnDimensions(simplices, n):
+  dims = [None]*n
+  for p, (first, last) in enumerate(simplices):
+    dims[first:last+1] = [p]*(last - first + 1)
+  return dims
+
+# REDUCE engines that work on a SparseMatrix, by name
+ENGINES = {"sparse": SortedColumns, "bitset": BitColumns}
+
+# Reduce columns (stored with a column backend) in the given order. pivots maps
+# each lowest one to the column that owns it, so finding a column with the same
+# lowest one is O(1) instead of the linear scan of equalLow
+# With clearing, once column j gets its lowest one in row i the column i is
+# known to reduce to zero and is cleared instead of reduced (this only saves
+# work if column i comes later in the order). Returns the number of nonzero
+# columns cleared
+# With a ReductionReport, or with V (the columns of the matrix V such that
+# R = D * V, stored with the same backend and updated along with the columns),
+# the tracked copy of the loop below is run instead. dims gives the dimension of
+# each column for the per-dimension statistics of the report
+def reduceColumns(columns, order, pivots, backend, clearing=False, report=None, dims=None, V=None):
+  if report is not None or V is not None:
+    return reduceColumnsTracked(columns, order, pivots, backend, clearing, report, dims, V)
+
+  low = backend.low
+  add = backend.add
+  cleared = 0
+
+  # for each column
+  for j in order:
+    col = columns[j]
+    i = low(col)
+
+    # while exists j0 < j s.t. low(j0) = low(j), add column j0 to column j
+    while i is not None and i in pivots:
+      col = add(col, columns[pivots[i]])
+      i = low(col)
+
+    columns[j] = col
+
+    # column j now owns its lowest one
+    if i is not None:
+      pivots[i] = j
+
+      # row i is a positive simplex, so its own column would reduce to zero
+      if clearing and columns[i]:
+        columns[i] = backend.fromRows([])
+        cleared += 1
+
+  return cleared
+
+# reduceColumns recording column additions, fill and pivot lookup time in
+# report, and each column addition in V as well, when they are not None
+def reduceColumnsTracked(columns, order, pivots, backend, clearing, report, dims, V):
+  low = backend.low
+  add = backend.add
+  clock = time.perf_counter
+  cleared = 0
+
+  for j in order:
+    dim = None if dims is None else dims[j]
+    col = columns[j]
+    i = low(col)
+
+    if report is not None:
+      start = clock()
+    owned = i is not None and i in pivots
+    if report is not None:
+      report.pivotLookupSeconds += clock() - start
+
+    while owned:
+      j0 = pivots[i]
+      col = add(col, columns[j0])
+      if V is not None:
+        V[j] = add(V[j], V[j0])
+      if report is not None:
+        report.addOperation(dim)
+      i = low(col)
+
+      if report is not None:
+        start = clock()
+      owned = i is not None and i in pivots
+      if report is not None:
+        report.pivotLookupSeconds += clock() - start
+
+    columns[j] = col
+    if report is not None:
+      report.addColumn(dim, backend.size(col))
+
+    if i is not None:
+      pivots[i] = j
+      if clearing and columns[i]:
+        columns[i] = backend.fromRows([])
+        cleared += 1
+        # column j is a cycle through simplex i, so D * col = 0 as it should
+        if V is not None:
+          V[i] = col
+
+  if report is not None:
+    report.cleared += cleared
+  return cleared
+
+# Apparent pairs of a matrix stored with a column backend: (i, j) is apparent if
+# i is the lowest one of column j and j is the first column with a 1 in row i
+# (j is the oldest coface of i). No column before j can ever get its lowest one
+# in row i, so column j is already reduced and column i reduces to zero.
+# Returns a dictionary lowest one -> column of the apparent pairs
+def apparentPairs(columns, backend):
+  first = {}
+  for j in range(len(columns)):
+    for i in backend.toRows(columns[j]):
+      first.setdefault(i, j)
+
+  pairs = {}
+  for j in range(len(columns)):
+    i = backend.low(columns[j])
+    if i is not None and first[i] == j:
+      pairs[i] = j
+  return pairs
+
+# Local phase of the chunk algorithm, run in a worker process of reduceSparse on
+# one group of columns: the columns ids (in the reduction order) whose lowest one
+# is in a row >= lowest, stored in columns, and V their columns of V (or None).
+# Each column is reduced with the earlier columns of the group while its lowest
+# one stays in a row >= lowest. Adding an earlier column is a step the global
+# pass could take as well, so the pairs do not change, but only the global pass
+# knows whether a column of another group gets the same lowest one first, so
+# nothing is paired here. The rows in blocked already have a pivot and are left
+# to the global pass. Returns the columns, their columns of V, the number of
+# additions into each column and, with timing, the seconds spent looking up
+# pivots (0.0 without)
+def reduceChunk(ids, columns, lowest, blocked, backend, V=None, timing=False):
+  low = backend.low
+  add = backend.add
+  clock = time.perf_counter
+  owners = {}
+  additions = {}
+  lookup = 0.0
+
+  for k, j in enumerate(ids):
+    col = columns[k]
+    i = low(col)
+    while True:
+      if timing:
+        start = clock()
+      owned = i is not None and i >= lowest and i in owners
+      if timing:
+        lookup += clock() - start
+      if not owned:
+        break
+      k0 = owners[i]
+      col = add(col, columns[k0])
+      if V is not None:
+        V[k] = add(V[k], V[k0])
+      additions[j] = additions.get(j, 0) + 1
+      i = low(col)
+    columns[k] = col
+
+    # the first column of the group with this lowest one
+    if i is not None and i >= lowest and i not in blocked:
+      owners[i] = k
+
+  return columns, V, additions, lookup
+
+# Local phase of the chunk algorithm for the columns of R in order (see
+# reduceSparse). The rows are cut into workers groups so that about as many
+# nonzero columns have their lowest one in each. While the lowest one of a
+# column stays in the rows of its group, only the columns of the group can have
+# the same one, so the groups are reduced in the process pool without looking at
+# each other (see reduceChunk), and each is sent its own columns only. A column
+# whose lowest one drops into the rows of a lower group joins that group, and
+# the groups that got new columns are reduced again, until no column moves.
+# Every column still goes through the global pass, which records its fill in
+# report, so the local phase only adds its additions and pivot lookup time
+def chunkPhase(pool, workers, R, order, report, dims):
+  columns = R.columns
+  backend = R.backend
+  V = R.V
+  low = backend.low
+  lows = {j: low(columns[j]) for j in order}
+  rows = sorted(i for i in lows.values() if i is not None)
+  if not rows:
+    return
+
+  # group g holds the lowest ones in rows cuts[g] to cuts[g+1]-1, and the rows
+  # that already have a pivot are left to the global pass
+  cuts = [rows[len(rows) * g // workers] for g in range(workers)]
+  group = lambda i: -1 if i is None or i < cuts[0] else bisect_right(cuts, i) - 1
+  blocked = [set() for g in range(workers)]
+  for i in R.pivots:
+    if group(i) >= 0:
+      blocked[group(i)].add(i)
+
+  active = set(range(workers))
+  while active:
+    groups = {g: [] for g in active}
+    for j in order:
+      g = group(lows[j])
+      if g in groups:
+        groups[g].append(j)
+    used = [g for g in sorted(groups) if groups[g]]
+    results = pool.map(reduceChunk, [groups[g] for g in used], [[columns[j] for j in groups[g]] for g in used],
+                       [cuts[g] for g in used], [blocked[g] for g in used], [backend]*len(used),
+                       [[V[j] for j in groups[g]] if V is not None else None for g in used],
+                       [report is not None]*len(used))
+
+    active = set()
+    for g, (block, vBlock, additions, lookup) in zip(used, results):
+      for j, col in zip(groups[g], block):
+        columns[j] = col
+        lows[j] = low(col)
+        if group(lows[j]) >= 0 and group(lows[j]) != g:
+          active.add(group(lows[j]))
+      if V is not None:
+        for j, col in zip(groups[g], vBlock):
+          V[j] = col
+      if report is not None:
+        report.pivotLookupSeconds += lookup
+        for j, count in additions.items():
+          report.addOperation(None if dims is None else dims[j], count, local=True)
+
+# Compute reduced matrix R with the sparse engine (see reduceColumns)
+# With clearing (the twist reduction) the columns are reduced one dimension at
+# a time from the highest to the lowest, using simplices (see the comment before
+# computeBetti), so every p-column whose row is the lowest one of a (p+1)-column
+# is cleared before its turn. The number of columns skipped is stored in R.cleared
+# With workers > 1 the chunk algorithm is used: the nonzero columns are split
+# into groups by the row of their lowest one, each group is reduced on its own
+# in a process pool (see chunkPhase), then a global pass reduces the columns in
+# order as without workers, which only has to finish what the groups left. With
+# clearing this is done once per dimension, highest first, so that the pairs of
+# a dimension clear the columns of the next before any local work is spent on
+# them. A column only ever gets earlier columns added, so the lowest ones (and
+# the persistence pairs) are the same as without workers, the other entries of
+# R may differ
+# report (a ReductionReport) collects statistics, per dimension if dims (the
+# dimension of each column) or simplices is given
+# With shortcuts the apparent pairs (see apparentPairs) are found in a pre-pass
+# over the columns and put straight into the pivot table, their columns are
+# neither reduced nor cleared later, and only the remaining columns go through
+# reduceColumns. Their number is stored in R.apparent. The remaining columns
+# that get paired without any column addition (emergent pairs) are only counted,
+# in R.emergent: on an explicit matrix they cannot be found ahead of the
+# reduction, as whether an earlier column ends up with the same lowest one is
+# only known once it is reduced, and reduceColumns already pairs them in O(1)
+# With recordV the matrix V such that R = D * V is recorded in R.V, one sparse
+# column per column of R (see representativeCycles). Cleared columns get the
+# column that cleared them, a cycle through their simplex
+def reduceSparse(boundaryMatrix, simplices=None, clearing=False, backend=SortedColumns, workers=1,
+                 report=None, dims=None, shortcuts=False, recordV=False):
+
+  # accept a dense list-of-lists, a SparseMatrix or a column source
+  with timed(report, "convert"):
+    R = SparseMatrix.fromMatrix(boundaryMatrix, backend)
+  columns = R.columns
+  if report is not None and dims is None and simplices is not None:
+    dims = columnDimensions(simplices, len(columns))
+
+  # left to right, or highest dimension first when clearing
+  if clearing:
+    if simplices is None:
+      raise ValueError("clearing needs the simplices dimension ranges")
+    order = [j for first, last in reversed(simplices) for j in range(first, last+1)]
+  else:
+    order = range(len(columns))
+
+  # V starts as the identity
+  V = [backend.fromRows([j]) for j in range(len(columns))] if recordV else None
+  R.V = V
+
+  # register the apparent pairs, the positive column of each pair is zero
+  R.apparent = 0
+  R.emergent = 0
+  if shortcuts:
+    with timed(report, "apparentPairs"):
+      pairs = apparentPairs(columns, backend)
+      R.pivots.update(pairs)
+      for i in pairs:
+        columns[i] = backend.fromRows([])
+        if recordV:
+          V[i] = columns[pairs[i]]
+      done = set(pairs).union(pairs.values())
+      order = [j for j in order if j not in done]
+      R.apparent = len(pairs)
+
+  # lowest ones before the reduction, to recognize the emergent pairs
+  if shortcuts:
+    pending = order
+    lows = [backend.low(columns[j]) for j in order]
+
+  # with workers, the chunk algorithm, with clearing in one round per dimension
+  R.cleared = 0
+  if workers > 1 and len(columns) > workers:
+    rounds = [order]
+    if clearing:
+      columnDims = columnDimensions(simplices, len(columns))
+      rounds = [[j for j in order if columnDims[j] == p] for p in reversed(range(len(simplices)))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      for part in rounds:
+        with timed(report, "chunks"):
+          chunkPhase(pool, workers, R, part, report, dims)
+        with timed(report, "reduce"):
+          R.cleared += reduceColumns(columns, part, R.pivots, backend, clearing, report, dims, V)
+  else:
+    with timed(report, "reduce"):
+      R.cleared += reduceColumns(columns, order, R.pivots, backend, clearing, report, dims, V)
+
+  # additions only ever make the lowest one of a column go up, so a column
+  # that kept its lowest one was paired without any
+  if shortcuts:
+    R.emergent = sum(1 for j, i in zip(pending, lows) if i is not None and backend.low(columns[j]) == i)
 
-  R = boundaryMatrix
+  return R
+
+# Compute the persistence pairs by reducing the coboundary matrix (persistent
+# cohomology) instead of the boundary matrix. The coboundary matrix is the
+# anti-transpose of the boundary matrix and has the same pairs, but on Rips and
+# alpha filtrations far fewer of its columns need any work, especially with
+# clearing, which then goes from the lowest dimension to the highest
+# The result is the reduced coboundary matrix, getLows maps its pairs back so
+# computeBetti and persistence give the same answers as for the reduced
+# boundary matrix
+def reduceCohomology(boundaryMatrix, simplices=None, clearing=False, backend=SortedColumns, workers=1,
+                     report=None, shortcuts=False):
+
+  with timed(report, "antiTranspose"):
+    A = SparseMatrix.fromMatrix(boundaryMatrix).antiTranspose()
+
+  # the p-simplices (first, last) are the columns (n-1-last, n-1-first) of the
+  # anti-transpose, so the dimensions appear from the highest to the lowest
+  coSimplices = None
+  dims = None
+  if simplices is not None:
+    n = len(A.columns)
+    coSimplices = [(n-1-last, n-1-first) for first, last in reversed(simplices)]
+    dims = columnDimensions(simplices, n)[::-1]
+
+  R = reduceSparse(A, coSimplices, clearing, backend, workers, report, dims, shortcuts)
+  R.antiTransposed = True
+  return R
+
+# Compute reduced matrix R from a boundary matrix
+# engine is "dense" for the original list-of-lists reduction, or the name of a
+# column backend in ENGINES ("sparse" for sorted row lists, "bitset" for XOR
+# bitsets), in which case reduceSparse returns a SparseMatrix. A SparseMatrix,
+# or any matrix read column by column (RipsFiltration, MappedMatrix), is always
+# reduced with reduceSparse
+# clearing=True uses the twist reduction of reduceSparse, it needs simplices
+# workers > 1 reduces with the parallel chunk algorithm of reduceSparse
+# cohomology=True reduces the coboundary matrix instead (see reduceCohomology)
+# report is an optional ReductionReport to fill in
+# shortcuts=True pairs the apparent pairs before the reduction (see reduceSparse)
+# recordV=True also records V, where R = D * V, for representativeCycles
+def REDUCE(boundaryMatrix, engine="dense", simplices=None, clearing=False, workers=1, cohomology=False,
+           report=None, shortcuts=False, recordV=False):
+
+  if engine == "dense" and (clearing or workers > 1 or cohomology or shortcuts or recordV
+                            or hasattr(boundaryMatrix, "column")):
+    engine = "sparse"
+  if engine in ENGINES and cohomology:
+    if recordV:
+      raise ValueError("representative cycles need the boundary matrix reduction, not cohomology")
+    return reduceCohomology(boundaryMatrix, simplices, clearing, ENGINES[engine], workers, report, shortcuts)
+  if engine in ENGINES:
+    return reduceSparse(boundaryMatrix, simplices, clearing, ENGINES[engine], workers, report, None, shortcuts,
+                        recordV)
+  if engine != "dense":
+    raise ValueError("unknown reduction engine: " + str(engine))
+
+  # the time spent in equalLow counts as pivot lookup time
+  if report is not None:
+    start = time.perf_counter()
+    dims = columnDimensions(simplices, len(boundaryMatrix[0])) if simplices is not None else None
+
+  # work on a copy so the boundary matrix can be reused
+  R = [row[:] for row in boundaryMatrix]
   lows = getLows(R)
 
   # for each column
   for j in range(len(R[0])):
 
     # if this column is not a zero column
-    if lows[j]:
+    if lows[j] is not None:
 
       # (fencepost loop)
       # get the index of the column that has the same low
-      j0 = equalLow(lows, j)
+      j0 = lowestOneOwner(lows, j, report)
 
       # while exists j0 < j s.t. low(j0) = low(j)
       while j0 != None:
@@ -61,23 +682,541 @@ def REDUCE(boundaryMatrix):
           R[row][j] = (R[row][j] + R[row][j0]) % 2
 
           # update lows[j]
-          if not lows[j] and R[row][j] == 1:
+          if lows[j] is None and R[row][j] == 1:
             lows[j] = row
 
+        if report is not None:
+          report.addOperation(dims[j] if dims else None)
+
         # update the boolean
-        j0 = equalLow(lows, j)
+        j0 = lowestOneOwner(lows, j, report)
+
+    if report is not None:
+      report.addColumn(dims[j] if dims else None, sum(R[row][j] for row in range(len(R))))
+
+  if report is not None:
+    report.phaseSeconds["reduce"] = report.phaseSeconds.get("reduce", 0.0) + time.perf_counter() - start
 
   return R
 
+# equalLow, adding the time it takes to report.pivotLookupSeconds if there is a report
+def lowestOneOwner(lows, j, report):
+  if report is None:
+    return equalLow(lows, j)
+  start = time.perf_counter()
+  j0 = equalLow(lows, j)
+  report.pivotLookupSeconds += time.perf_counter() - start
+  return j0
+
+
+# Columns of an implicit boundary matrix for reduceColumns. A column is generated
+# from source.column(j) the first time it is needed and only the nonzero reduced
+# columns are kept, so the unreduced matrix is never materialized
+class ImplicitColumns(object):
+
+  def __init__(self, source, backend=SortedColumns):
+    self.source = source
+    self.backend = backend
+    # reduced nonzero columns, and columns known to be zero
+    self.reduced = {}
+    self.zero = set()
+
+  def __getitem__(self, j):
+    if j in self.reduced:
+      return self.reduced[j]
+    if j in self.zero:
+      return self.backend.fromRows([])
+    return self.backend.fromRows(self.source.column(j))
+
+  def __setitem__(self, j, col):
+    if col:
+      self.reduced[j] = col
+    else:
+      self.reduced.pop(j, None)
+      self.zero.add(j)
+
+# Vietoris-Rips filtration of a point cloud (an N x d array of points). A simplex
+# enters when all its vertices are pairwise within distance threshold, at the
+# length of its longest edge. Simplices go up to dimension maxDim+1 so that
+# homology is correct up to dimension maxDim
+# Simplices are sorted by (value, dimension), column j of the boundary matrix
+# is the j-th simplex. Each simplex is stored as its index in the combinatorial
+# number system (vertices v0 < v1 < ... < vk have index C(v0,1) + ... + C(vk,k+1))
+# and its boundary column is generated on the fly by column(j)
+class RipsFiltration(object):
+
+  def __init__(self, points, maxDim, threshold, blockSize=1024):
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    self.maxDim = maxDim
+    self.threshold = threshold
+
+    # binomial[k][v] = C(v, k), enough to encode simplices of maxDim+2 vertices
+    self.binomial = [[comb(v, k) for v in range(n+1)] for k in range(maxDim+3)]
+
+    # pairwise distances, one block of rows at a time so that only a
+    # blockSize x N slice of the distance matrix exists at once
+    # upper[v] maps each neighbor u > v to the length of the edge vu
+    upper = [dict() for v in range(n)]
+    squares = np.einsum("ij,ij->i", points, points)
+    for start in range(0, n, blockSize):
+      block = points[start:start+blockSize]
+      distances = squares[start:start+blockSize, None] + squares[None, :] - 2*(block @ points.T)
+      distances = np.sqrt(np.maximum(distances, 0))
+      rows, cols = np.nonzero(distances <= threshold)
+      keep = cols > rows + start
+      for v, u, d in zip(rows[keep] + start, cols[keep], distances[rows[keep], cols[keep]]):
+        upper[v][u] = float(d)
+
+    # enumerate the cliques one dimension at a time: a k-simplex extends to a
+    # (k+1)-simplex by any vertex that is an upper neighbor of all its vertices
+    keys = []
+    values = []
+    dims = []
+    level = [((v,), 0.0) for v in range(n)]
+    for dim in range(maxDim+2):
+      nextLevel = []
+      for simplex, value in level:
+        keys.append(self.encode(simplex))
+        values.append(value)
+        dims.append(dim)
+        if dim <= maxDim:
+          common = upper[simplex[0]].keys()
+          for v in simplex[1:]:
+            common = common & upper[v].keys()
+          for w in common:
+            nextLevel.append((simplex + (w,), max([value] + [upper[v][w] for v in simplex])))
+      level = nextLevel
+
+    # filtration order, faces come first since they have smaller values or
+    # the same value and a smaller dimension (the sort is stable)
+    order = np.lexsort((dims, values))
+    self.keys = [keys[s] for s in order]
+    self.values = np.asarray(values)[order]
+    self.dims = np.asarray(dims)[order]
+
+    # key of a simplex -> its column, one dictionary per dimension
+    self.position = [dict() for dim in range(maxDim+2)]
+    for j in range(len(self.keys)):
+      self.position[self.dims[j]][self.keys[j]] = j
+
+  def __len__(self):
+    return len(self.keys)
+
+  # index of a sorted tuple of vertices in the combinatorial number system
+  def encode(self, simplex):
+    return sum(self.binomial[m+1][v] for m, v in enumerate(simplex))
+
+  # sorted tuple of the dim+1 vertices of the simplex with index key
+  def decode(self, key, dim):
+    vertices = []
+    for m in range(dim+1, 0, -1):
+      # largest vertex v with C(v, m) <= key
+      v = bisect_right(self.binomial[m], key) - 1
+      vertices.append(v)
+      key -= self.binomial[m][v]
+    return tuple(reversed(vertices))
+
+  # rows of column j of the boundary matrix: the columns of the facets of simplex j
+  def column(self, j):
+    dim = int(self.dims[j])
+    if dim == 0:
+      return []
+    simplex = self.decode(self.keys[j], dim)
+    facets = self.position[dim-1]
+    return sorted(facets[self.encode(simplex[:r] + simplex[r+1:])] for r in range(dim+1))
+
+  # same result as getLows on the reduced boundary matrix, after reduce()
+  def getLows(self):
+    lows = [None]*len(self.keys)
+    for i, j in self.pivots.items():
+      lows[j] = i
+    return lows
+
+  # reduce the implicit boundary matrix with the sparse engine, by default with
+  # clearing, one dimension at a time from the highest to the lowest
+  # report is an optional ReductionReport to fill in
+  def reduce(self, clearing=True, backend=SortedColumns, report=None):
+    if clearing:
+      order = [j for dim in range(self.maxDim+1, -1, -1) for j in np.flatnonzero(self.dims == dim).tolist()]
+    else:
+      order = range(len(self.keys))
+    self.pivots = {}
+    with timed(report, "reduce"):
+      self.cleared = reduceColumns(ImplicitColumns(self, backend), order, self.pivots, backend, clearing,
+                                   report, self.dims.tolist())
+    return self
+
+  # persistence diagrams of dimensions 0 to maxDim as arrays of DIAGRAM_DTYPE
+  # (see diagrams), without the pairs of zero persistence
+  def diagrams(self):
+    if not hasattr(self, "pivots"):
+      self.reduce()
+    result = diagrams(self, values=self.values, dims=self.dims)[:self.maxDim+1]
+    return [diagram[diagram["death"] > diagram["birth"]] for diagram in result]
+
+  # points of the p-dimensional persistence diagram as (birth, death) pairs of
+  # filtration values, death is 'INF' for classes that never die. Pairs with
+  # zero persistence (birth == death) are left out
+  def persistence(self, p):
+    if not hasattr(self, "pivots"):
+      self.reduce()
+    points = []
+    deaths = set(self.pivots.values())
+    for i in np.flatnonzero(self.dims == p).tolist():
+      if i in self.pivots:
+        birth = float(self.values[i])
+        death = float(self.values[self.pivots[i]])
+        if death > birth:
+          points += [(birth, death)]
+      elif i not in deaths:
+        points += [(float(self.values[i]), 'INF')]
+    return points
+
+
+# Persistence of a filtration that keeps growing. Simplices are added in batches
+# in filtration order, each one given by the list of the columns of its facets,
+# and only the new columns are reduced against the pivot table kept from the
+# earlier batches. Diagrams and Betti numbers are updated as each column is
+# paired, so the cost of a batch depends on the batch, not on the history
+class IncrementalPersistence(object):
+
+  def __init__(self, backend=SortedColumns):
+    self.backend = backend
+    # reduced columns, lowest one -> column, dimension and value of each simplex
+    self.columns = []
+    self.pivots = {}
+    self.dims = []
+    self.values = []
+    # for each dimension, the (birth, death) column pairs and the columns of
+    # the classes that are still alive (a dict used as an ordered set)
+    self.pairs = []
+    self.alive = []
+
+  def __len__(self):
+    return len(self.columns)
+
+  # Add a batch of simplices. boundaries[k] lists the columns of the facets of
+  # the k-th new simplex, these must already be in the filtration. dims defaults
+  # to the number of facets minus one (0 for vertices) and values to the
+  # 1-based column number, as in the points returned by persistence
+  def addSimplices(self, boundaries, dims=None, values=None):
+    start = len(self.columns)
+    end = start + len(boundaries)
+
+    # check the whole batch before changing anything, so that a bad batch leaves
+    # the filtration as it was
+    for k in range(len(boundaries)):
+      if any(row >= start + k for row in boundaries[k]):
+        raise ValueError("a simplex must come after its facets in the filtration")
+    dims = [max(len(rows)-1, 0) for rows in boundaries] if dims is None else list(dims)
+    values = list(range(start+1, end+1)) if values is None else list(values)
+    if len(dims) != len(boundaries) or len(values) != len(boundaries):
+      raise ValueError("dims and values need one entry per simplex")
+
+    self.columns += [self.backend.fromRows(rows) for rows in boundaries]
+    self.dims += dims
+    self.values += values
+
+    reduceColumns(self.columns, range(start, end), self.pivots, self.backend)
+
+    # grow the per-dimension structures if this batch reaches a new dimension
+    while len(self.pairs) <= max(self.dims[start:end], default=-1):
+      self.pairs.append([])
+      self.alive.append({})
+
+    # a zero column gives birth to a class, otherwise it kills the class born
+    # at its lowest one
+    for j in range(start, end):
+      i = self.backend.low(self.columns[j])
+      if i is None:
+        self.alive[self.dims[j]][j] = None
+      else:
+        del self.alive[self.dims[i]][i]
+        self.pairs[self.dims[i]].append((i, j))
+
+  # Betti numbers of the complex built so far, one for each dimension
+  def betti(self):
+    return [len(alive) for alive in self.alive]
+
+  # points of the p-dimensional persistence diagram of the filtration so far,
+  # (birth, death) values sorted by birth, death is 'INF' if the class is alive
+  def persistence(self, p):
+    if p >= len(self.pairs):
+      return []
+    points = [(i, self.values[j]) for i, j in self.pairs[p]]
+    points += [(i, 'INF') for i in self.alive[p]]
+    points.sort(key=lambda point: point[0])
+    return [(self.values[i], death) for i, death in points]
+
+  # same result as getLows on the reduced boundary matrix of the filtration so far
+  def getLows(self):
+    return [self.backend.low(col) for col in self.columns]
+
+
+# Binary file format for sparse boundary matrices, read with numpy.memmap:
+#   header      BOUNDARY_HEADER: magic, version, number of columns n, number of
+#               nonzero entries, number of dimensions, bytes per row index (4 or 8)
+#   simplices   int64 (dimensions, 2), the dimension ranges (see computeBetti)
+#   offsets     int64 (n+1), column j holds rows[offsets[j]:offsets[j+1]]
+#   rows        int32 or int64 (nonzeros), the sorted rows of every column
+# All numbers are little-endian
+BOUNDARY_MAGIC = b"BNDRYMAT"
+BOUNDARY_HEADER = np.dtype([("magic", "S8"), ("version", "<i8"), ("columns", "<i8"),
+                            ("nonzeros", "<i8"), ("dimensions", "<i8"), ("rowBytes", "<i8")])
+
+# Write a boundary matrix (anything SparseMatrix.fromMatrix accepts, read one
+# column at a time if it has column(j)) and its simplices to path. Rows are
+# stored as int32 whenever the matrix has fewer than 2^31 rows
+def writeBoundaryMatrix(path, matrix, simplices):
+  if not hasattr(matrix, "column"):
+    matrix = SparseMatrix.fromMatrix(matrix)
+  writer = BoundaryWriter(path, len(matrix), simplices)
+  for j in range(len(matrix)):
+    writer.append(matrix.column(j))
+  writer.close()
+
+# Writes the n columns of a boundary matrix file one after the other, streaming
+# the rows to disk, only the offsets stay in memory. Columns already written can
+# be read back with read(j). close() writes the header and the offsets
+class BoundaryWriter(object):
+
+  def __init__(self, path, n, simplices, rowType=None):
+    self.n = n
+    self.simplices = simplices
+    self.rowType = rowType or (np.dtype("<i4") if n < 2**31 else np.dtype("<i8"))
+    self.offsets = np.zeros(n+1, dtype="<i8")
+    self.written = 0
+    self.rowsStart = BOUNDARY_HEADER.itemsize + 16*len(simplices) + 8*(n+1)
+    self.file = open(path, "w+b")
+    self.file.seek(self.rowsStart)
+
+  # write the next column, a sorted list of rows
+  def append(self, col):
+    j = self.written
+    self.file.write(np.asarray(col, dtype=self.rowType).tobytes())
+    self.offsets[j+1] = self.offsets[j] + len(col)
+    self.written += 1
+
+  # the sorted rows of column j, which must already be written. The file is
+  # left positioned after the last column written, for append
+  def read(self, j):
+    count = int(self.offsets[j+1] - self.offsets[j])
+    start = self.rowsStart + int(self.offsets[j])*self.rowType.itemsize
+    end = self.file.tell()
+    self.file.seek(start)
+    data = self.file.read(count*self.rowType.itemsize)
+    self.file.seek(end)
+    return np.frombuffer(data, dtype=self.rowType).tolist()
+
+  def close(self):
+    if self.written != self.n:
+      raise ValueError("expected " + str(self.n) + " columns, got " + str(self.written))
+    header = np.array([(BOUNDARY_MAGIC, 1, self.n, self.offsets[self.n], len(self.simplices),
+                        self.rowType.itemsize)], dtype=BOUNDARY_HEADER)
+    self.file.seek(0)
+    self.file.write(header.tobytes())
+    self.file.write(np.asarray(self.simplices, dtype="<i8").reshape(-1, 2).tobytes())
+    self.file.write(self.offsets.tobytes())
+    self.file.close()
+
+# A boundary matrix file (see writeBoundaryMatrix) mapped into memory with
+# numpy.memmap, so columns are only read from disk when they are used. It can
+# be passed to REDUCE, getLows, computeBetti, persistence and diagrams
+class MappedMatrix(object):
+
+  def __init__(self, path):
+    self.path = path
+    header = np.fromfile(path, dtype=BOUNDARY_HEADER, count=1)
+    if len(header) == 0 or header[0]["magic"] != BOUNDARY_MAGIC:
+      raise ValueError(str(path) + " is not a boundary matrix file")
+    header = header[0]
+    n = int(header["columns"])
+    nonzeros = int(header["nonzeros"])
+    self.rowType = np.dtype("<i4") if header["rowBytes"] == 4 else np.dtype("<i8")
+
+    start = BOUNDARY_HEADER.itemsize
+    ranges = np.fromfile(path, dtype="<i8", count=2*int(header["dimensions"]), offset=start)
+    self.simplices = [tuple(r) for r in ranges.reshape(-1, 2).tolist()]
+    start += ranges.nbytes
+    self.offsets = np.memmap(path, dtype="<i8", mode="r", offset=start, shape=(n+1,))
+    start += self.offsets.nbytes
+    self.rowsStart = start
+    # numpy cannot map an empty range
+    if nonzeros:
+      self.rows = np.memmap(path, dtype=self.rowType, mode="r", offset=start, shape=(nonzeros,))
+    else:
+      self.rows = np.zeros(0, dtype=self.rowType)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  # the sorted list of the rows of column j that hold a 1
+  def column(self, j):
+    return self.rows[self.offsets[j]:self.offsets[j+1]].tolist()
+
+  # the last row of every nonempty column, read without loading the columns
+  def getLows(self):
+    ends = np.asarray(self.offsets[1:])
+    nonempty = ends > np.asarray(self.offsets[:-1])
+    lows = np.full(len(ends), -1, dtype=np.int64)
+    lows[nonempty] = self.rows[ends[nonempty] - 1]
+    return [None if i < 0 else i for i in lows.tolist()]
+
+  # expand into a dense list-of-lists matrix
+  def toDense(self):
+    return SparseMatrix.fromMatrix(self).toDense()
+
+# Reduce the boundary matrix in the file path without loading it: columns are
+# streamed from the memory-mapped input in order and each reduced column is
+# appended to the output file outPath (same format) as soon as it is final.
+# Columns needed for additions are read back from the output file, the
+# cacheSize most recently used ones are kept in memory. Apart from that cache,
+# memory holds only the pivot table and the column offsets. Returns the reduced
+# matrix as a MappedMatrix of outPath
+def reduceOutOfCore(path, outPath, cacheSize=1024):
+  D = MappedMatrix(path)
+  writer = BoundaryWriter(outPath, len(D), D.simplices, D.rowType)
+  add = SortedColumns.add
+  pivots = {}
+  cache = OrderedDict()
+
+  # a reduced column, from the cache or from the part of outPath written so far
+  def reducedColumn(j):
+    if j in cache:
+      cache.move_to_end(j)
+      return cache[j]
+    return remember(j, writer.read(j))
+
+  def remember(j, col):
+    cache[j] = col
+    if len(cache) > cacheSize:
+      cache.popitem(last=False)
+    return col
+
+  for j in range(len(D)):
+    col = D.column(j)
+
+    # while exists j0 < j s.t. low(j0) = low(j), add column j0 to column j
+    while col and col[-1] in pivots:
+      col = add(col, reducedColumn(pivots[col[-1]]))
+
+    writer.append(col)
+    if col:
+      pivots[col[-1]] = j
+      remember(j, col)
+
+  writer.close()
+  return MappedMatrix(outPath)
+
+# Content hash of a boundary matrix (anything SparseMatrix.fromMatrix accepts)
+# and its simplices: SHA-256 of the dimension ranges, the column offsets and
+# the rows, all as int64, so the same matrix gets the same key whatever its
+# representation
+def matrixKey(boundaryMatrix, simplices):
+  if isinstance(boundaryMatrix, MappedMatrix):
+    offsets = np.asarray(boundaryMatrix.offsets, dtype="<i8")
+    rows = np.asarray(boundaryMatrix.rows, dtype="<i8")
+  else:
+    if not hasattr(boundaryMatrix, "column"):
+      boundaryMatrix = SparseMatrix.fromMatrix(boundaryMatrix)
+    columns = [boundaryMatrix.column(j) for j in range(len(boundaryMatrix))]
+    offsets = np.concatenate(([0], np.cumsum([len(col) for col in columns], dtype="<i8"))).astype("<i8")
+    rows = np.fromiter((row for col in columns for row in col), dtype="<i8", count=int(offsets[-1]))
+
+  digest = hashlib.sha256(b"boundary matrix v1")
+  digest.update(np.asarray(simplices, dtype="<i8").tobytes())
+  digest.update(offsets.tobytes())
+  digest.update(rows.tobytes())
+  return digest.hexdigest()
+
+# Pairs and diagrams of a reduced matrix, as kept by PersistenceCache. It has
+# getLows, so it can stand in for R in computeBetti, persistence and diagrams
+class PersistenceResult(object):
+
+  def __init__(self, lows, diagramList):
+    # lows as an int64 array, -1 for a zero column
+    self.lows = lows
+    self.diagrams = diagramList
+
+  def getLows(self):
+    return [None if i < 0 else i for i in self.lows.tolist()]
+
+# Cache of reductions keyed by matrixKey. reduce() returns the PersistenceResult
+# of a boundary matrix, reducing it only on a miss. Up to maxEntries results are
+# kept in memory, the least recently used is dropped first; with a directory the
+# results are also saved there (one .npz file per key) and found again by later
+# jobs. The input matrix is never modified
+class PersistenceCache(object):
+
+  def __init__(self, maxEntries=128, directory=None):
+    self.maxEntries = maxEntries
+    self.directory = directory
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+
+  # the PersistenceResult of a boundary matrix, options are passed to REDUCE
+  # (they change how the pairs are computed, not the pairs, so they are not
+  # part of the key)
+  def reduce(self, boundaryMatrix, simplices, **options):
+    key = matrixKey(boundaryMatrix, simplices)
+
+    result = self.entries.get(key)
+    if result is None and self.directory is not None:
+      result = self.load(key)
+    if result is not None:
+      self.hits += 1
+      self.remember(key, result)
+      return result
+
+    self.misses += 1
+    lows = getLows(REDUCE(boundaryMatrix, simplices=simplices, **options))
+    result = PersistenceResult(np.array([-1 if i is None else i for i in lows], dtype=np.int64),
+                               diagramsFromLows(lows, simplices, None, None))
+    self.remember(key, result)
+    if self.directory is not None:
+      self.save(key, result)
+    return result
+
+  def remember(self, key, result):
+    self.entries[key] = result
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.maxEntries:
+      self.entries.popitem(last=False)
+
+  def path(self, key):
+    return os.path.join(self.directory, key + ".npz")
+
+  def save(self, key, result):
+    arrays = {"lows": result.lows}
+    for p, diagram in enumerate(result.diagrams):
+      arrays["diagram" + str(p)] = diagram
+    # write under a temporary name first so other jobs never see half a file
+    temporary = self.path(key) + "." + str(os.getpid()) + ".tmp"
+    with open(temporary, "wb") as f:
+      np.savez(f, **arrays)
+    os.replace(temporary, self.path(key))
+
+  def load(self, key):
+    if not os.path.exists(self.path(key)):
+      return None
+    with np.load(self.path(key)) as arrays:
+      count = sum(1 for name in arrays.files if name.startswith("diagram"))
+      return PersistenceResult(arrays["lows"], [arrays["diagram" + str(p)] for p in range(count)])
 
 # Compute zp (rank of p-cycles) and bp (rank of p-boundaries) for each dimension
 # then use them to compute Betti numbers
 # Simplices is a list, at each index p in the list there is a tuple representing
 # the column numbers of the first and last columns that correspond to simplices
 # of dimension p
-def computeBetti(R, simplices):
+# report is an optional ReductionReport that gets the time of getLows
+def computeBetti(R, simplices, report=None):
 
-  lows = getLows(R)
+  with timed(report, "getLows"):
+    lows = getLows(R)
 
   # initialize to zeroes
   zp = [0]*len(simplices)
@@ -89,7 +1228,7 @@ def computeBetti(R, simplices):
     # for each of the simplices of that dimension
     for col in range(simplices[a][0], simplices[a][1]+1):
       # if the corresponding column is a zero column
-      if not lows[col]:
+      if lows[col] is None:
         # add it to zp for that dimension
         zp[a] += 1
 
@@ -108,31 +1247,86 @@ def computeBetti(R, simplices):
 
   return zp, bp, betti
 
+# Rank over Z/2 of a matrix given as a list of columns (lists of rows), by
+# sparse elimination. Only the rank matters, not the filtration order, so the
+# columns are taken sparsest first and the rows are renumbered so that the
+# rows used by the fewest columns are the lowest ones: pivots are then chosen
+# where they cause the least fill-in
+def rankGF2(columns):
+  uses = {}
+  for col in columns:
+    for row in col:
+      uses[row] = uses.get(row, 0) + 1
+  rank = {row: k for k, row in enumerate(sorted(uses, key=lambda row: -uses[row]))}
+
+  reduced = [sorted(rank[row] for row in col) for col in sorted(columns, key=len)]
+  pivots = {}
+  reduceColumns(reduced, range(len(reduced)), pivots, SortedColumns)
+  return len(pivots)
+
+# Betti numbers without a full reduction: each boundary operator d_p (the
+# p-columns of the boundary matrix restricted to the (p-1)-rows) is taken on
+# its own and only its rank over Z/2 is computed (see rankGF2), in a process
+# pool when workers > 1. Then zp = (number of p-simplices) - rank d_p and
+# bp = rank d_(p+1). Same result as computeBetti, without printing
+def fastBetti(boundaryMatrix, simplices, workers=1):
+  if not hasattr(boundaryMatrix, "column"):
+    boundaryMatrix = SparseMatrix.fromMatrix(boundaryMatrix)
+
+  # the boundary operator of each dimension p >= 1
+  operators = [[boundaryMatrix.column(j) for j in range(first, last+1)] for first, last in simplices[1:]]
+  if workers > 1:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      ranks = [0] + list(pool.map(rankGF2, operators))
+  else:
+    ranks = [0] + [rankGF2(operator) for operator in operators]
+  ranks.append(0)
+
+  zp = [(last - first + 1) - ranks[p] for p, (first, last) in enumerate(simplices)]
+  bp = [ranks[p+1] for p in range(len(simplices))]
+  betti = [zp[p] - bp[p] for p in range(len(simplices))]
+  return zp, bp, betti
+
+# Map each row that holds a lowest one to the first column that has it there
+def lowColumns(lows):
+  deathOf = {}
+  for j in range(len(lows)-1, -1, -1):
+    if lows[j] is not None:
+      deathOf[lows[j]] = j
+  return deathOf
+
 # Find the points in the p-dimensional persistence diagram
 # Inputs are a dimension p, a reduced matrix R, and simplices
 # (For explanation of simplices, see comment before computeBetti)
-def persistence(p, R, simplices):
+# report is an optional ReductionReport that gets the time of getLows and of
+# finding the columns of the lows
+def persistence(p, R, simplices, report=None):
 
   # initialize
-  lows = getLows(R)
+  with timed(report, "getLows"):
+    lows = getLows(R)
   points = []
 
+  # row -> the first column that has its lowest one in that row
+  with timed(report, "pairs"):
+    deathOf = lowColumns(lows)
+
   # for each row i corresponding to a p-simplex
   for i in range(simplices[p][0], simplices[p][1]+1):
 
     # if row i contains a "lowest one"
-    if i in lows:
+    if i in deathOf:
       # get the column j that row i has the "lowest one" of
-      j = lows.index(i)
+      j = deathOf[i]
       # if j corresponds to a (p+1) simplex
       if j >= simplices[p+1][0] and j <= simplices[p+1][1]+1:
         # add i,j to the list of points
         points += [(i+1,j+1)]
 
     # if column i is a zero column (has no lowest one)
-    if not lows[i]:
+    if lows[i] is None:
       # if row i doesn't have a lowest one in it
-      if i not in lows:
+      if i not in deathOf:
         # add (i, infinity) to the persistence diagram
         points += [(i+1, 'INF')]
 
@@ -141,6 +1335,74 @@ def persistence(p, R, simplices):
   
   return points
 
+# Representative cycles of bars given as points returned by persistence, from
+# a matrix reduced with recordV=True. A cycle is the sorted list of the 1-based
+# numbers of its simplices, like the points. For a bar (i, j) it is column j of
+# R, a cycle born at i that becomes a boundary at j; for a bar (i, 'INF') it is
+# column i of V, the cycle created by simplex i
+def representativeCycles(R, points):
+  if getattr(R, "V", None) is None:
+    raise ValueError("representative cycles need a matrix reduced with recordV=True")
+
+  cycles = []
+  for birth, death in points:
+    if death == 'INF':
+      rows = R.backend.toRows(R.V[birth-1])
+    else:
+      rows = R.column(death-1)
+    cycles.append([row+1 for row in rows])
+  return cycles
+
+# Persistence diagrams of every dimension from a single pass over the lows
+# Each diagram is a NumPy structured array of DIAGRAM_DTYPE with one point per
+# row, sorted by birth. A pair (i, j) gives birth values[i] and death values[j],
+# a class that never dies has death inf and infinite True. values defaults to
+# the 1-based column numbers used by persistence
+# The dimension of each column comes from simplices (see the comment before
+# computeBetti), or directly from dims, an array holding the dimension of
+# every column. Nothing is printed
+# report is an optional ReductionReport that gets the time of getLows and of
+# the extraction
+def diagrams(R, simplices=None, values=None, dims=None, report=None):
+  with timed(report, "getLows"):
+    lows = getLows(R)
+  with timed(report, "diagrams"):
+    return diagramsFromLows(lows, simplices, values, dims)
+
+# diagrams, once the lows are known
+def diagramsFromLows(lows, simplices, values, dims):
+  n = len(lows)
+
+  if dims is None:
+    dims = np.full(n, -1)
+    for p, (first, last) in enumerate(simplices):
+      dims[first:last+1] = p
+  dims = np.asarray(dims)
+  values = np.arange(1, n+1, dtype=float) if values is None else np.asarray(values, dtype=float)
+
+  # low[j] = lowest one of column j (-1 for a zero column) and
+  # death[i] = column whose lowest one is in row i (-1 if there is none)
+  low = np.array([-1 if i is None else i for i in lows], dtype=np.int64)
+  death = np.full(n, -1, dtype=np.int64)
+  negative = np.flatnonzero(low >= 0)
+  death[low[negative][::-1]] = negative[::-1]
+
+  # a row is a birth if it is paired, or if its column is zero and unpaired
+  finite = death >= 0
+  births = finite | (low < 0)
+  deathValues = np.where(finite, values[death], np.inf)
+
+  result = []
+  for p in range(int(dims.max()) + 1 if n else 0):
+    rows = np.flatnonzero(births & (dims == p))
+    diagram = np.empty(len(rows), dtype=DIAGRAM_DTYPE)
+    diagram["birth"] = values[rows]
+    diagram["death"] = deathValues[rows]
+    diagram["infinite"] = ~finite[rows]
+    result.append(diagram)
+
+  return result
+
 # compute a norm for a persistence diagram as the sum of the areas of triangles
 # created by drawing vertical and horizontal lines from each point to the diagonal
 # (beta version - not sure how is best to handle INF values)
@@ -157,20 +1419,354 @@ def norm(p, points):
   print(str(p) + "-dimensional L1-norm: " + str(norm))
   return norm
 
-# given a list of points, create a persistence diagram
-def plot(points):
+# Split a persistence diagram, either the points returned by persistence or an
+# array returned by diagrams, into a (k, 2) array of the finite (birth, death)
+# points and the sorted array of the births of the infinite ones
+def splitDiagram(points):
+  if isinstance(points, np.ndarray):
+    finite = points[~points["infinite"]]
+    return np.column_stack((finite["birth"], finite["death"])), np.sort(points["birth"][points["infinite"]])
+  finite = [(birth, death) for birth, death in points if death != 'INF']
+  infinite = sorted(birth for birth, death in points if death == 'INF')
+  return np.array(finite, dtype=float).reshape(-1, 2), np.array(infinite, dtype=float)
+
+# Costs of matching the finite points of two diagrams, in the L-infinity norm.
+# The rows are the points of A followed by one diagonal slot per point of B, the
+# columns are the points of B followed by one diagonal slot per point of A. A
+# point is matched to its own slot for half its persistence, any two diagonal
+# slots are matched for free, and every other diagonal pairing is forbidden (inf)
+def matchingCosts(A, B):
+  m = len(A)
+  k = len(B)
+  costs = np.full((m+k, m+k), np.inf)
+  costs[:m, :k] = np.maximum(np.abs(A[:, None, 0] - B[None, :, 0]), np.abs(A[:, None, 1] - B[None, :, 1]))
+  costs[np.arange(m), k + np.arange(m)] = (A[:, 1] - A[:, 0]) / 2
+  costs[m + np.arange(k), np.arange(k)] = (B[:, 1] - B[:, 0]) / 2
+  costs[m:, k:] = 0
+  return costs
+
+# Minimum cost perfect matching of a square cost matrix with the Hungarian
+# algorithm (shortest augmenting paths with potentials, O(n^3)), the rows of the
+# potentials are updated with NumPy. Returns col, where col[i] is the column
+# matched to row i
+def linearAssignment(costs):
+  n = len(costs)
+  # potentials u (rows) and v (columns), p[j] = row matched to column j, the
+  # index 0 is a virtual column used as the root of each augmenting path
+  u = np.zeros(n+1)
+  v = np.zeros(n+1)
+  p = np.zeros(n+1, dtype=np.int64)
+  way = np.zeros(n+1, dtype=np.int64)
+
+  for i in range(1, n+1):
+    p[0] = i
+    j0 = 0
+    minv = np.full(n+1, np.inf)
+    used = np.zeros(n+1, dtype=bool)
+
+    # grow the tree of tight edges until it reaches a free column
+    while True:
+      used[j0] = True
+      i0 = p[j0]
+      reduced = costs[i0-1] - u[i0] - v[1:]
+      better = ~used[1:] & (reduced < minv[1:])
+      minv[1:][better] = reduced[better]
+      way[1:][better] = j0
+      j1 = int(np.argmin(np.where(used[1:], np.inf, minv[1:]))) + 1
+      delta = minv[j1]
+      u[p[used]] += delta
+      v[used] -= delta
+      minv[~used] -= delta
+      j0 = j1
+      if p[j0] == 0:
+        break
+
+    # flip the augmenting path
+    while j0:
+      j1 = way[j0]
+      p[j0] = p[j1]
+      j0 = j1
+
+  col = np.zeros(n, dtype=np.int64)
+  col[p[1:] - 1] = np.arange(n)
+  return col
+
+# Size of a maximum matching of a bipartite graph with the Hopcroft-Karp
+# algorithm. adjacency[i] lists the right vertices adjacent to left vertex i
+def maximumMatching(adjacency, numRight):
+  matchLeft = [-1]*len(adjacency)
+  matchRight = [-1]*numRight
+  size = 0
+
+  while True:
+    # breadth first search from the free left vertices, layering the graph
+    layer = [-1]*len(adjacency)
+    queue = [i for i in range(len(adjacency)) if matchLeft[i] == -1]
+    for i in queue:
+      layer[i] = 0
+    found = False
+    for i in queue:
+      for j in adjacency[i]:
+        k = matchRight[j]
+        if k == -1:
+          found = True
+        elif layer[k] == -1:
+          layer[k] = layer[i] + 1
+          queue.append(k)
+    if not found:
+      return size
+
+    # depth first search for vertex-disjoint shortest augmenting paths
+    for start in range(len(adjacency)):
+      if matchLeft[start] != -1:
+        continue
+      stack = [(start, iter(adjacency[start]))]
+      while stack:
+        i, neighbors = stack[-1]
+        for j in neighbors:
+          k = matchRight[j]
+          if k == -1:
+            # augment along the stack
+            for i, neighbors in reversed(stack):
+              matchRight[j], matchLeft[i], j = i, j, matchLeft[i]
+            size += 1
+            stack = []
+            break
+          if layer[k] == layer[i] + 1:
+            stack.append((k, iter(adjacency[k])))
+            break
+        else:
+          # dead end, never visit i again in this phase
+          layer[i] = -1
+          stack.pop()
+
+# Bottleneck distance between two persistence diagrams (see splitDiagram):
+# the smallest t such that the points can be matched to each other or to the
+# diagonal moving no point more than t in the L-infinity norm. Found by a
+# binary search over the candidate costs, each step checking for a perfect
+# matching with Hopcroft-Karp. Infinite points are matched by birth, if the
+# diagrams have a different number of them the distance is inf
+def bottleneck(A, B):
+  A, infiniteA = splitDiagram(A)
+  B, infiniteB = splitDiagram(B)
+  if len(infiniteA) != len(infiniteB):
+    return np.inf
+  infinite = float(np.max(np.abs(infiniteA - infiniteB))) if len(infiniteA) else 0.0
+
+  costs = matchingCosts(A, B)
+  candidates = np.unique(costs[np.isfinite(costs)])
+  n = len(costs)
+
+  # smallest candidate that allows a perfect matching
+  low = 0
+  high = len(candidates) - 1
+  while low < high:
+    middle = (low + high) // 2
+    adjacency = [np.flatnonzero(row <= candidates[middle]).tolist() for row in costs]
+    if maximumMatching(adjacency, n) == n:
+      high = middle
+    else:
+      low = middle + 1
+
+  finite = float(candidates[low]) if n else 0.0
+  return max(finite, infinite)
+
+# Wasserstein distance of the given order between two persistence diagrams (see
+# splitDiagram): the order-th root of the smallest sum of the order-th powers of
+# the L-infinity distances over all matchings of the points to each other or to
+# the diagonal, found with the Hungarian algorithm. Infinite points are matched
+# by birth, if the diagrams have a different number of them the distance is inf
+def wasserstein(A, B, order=2):
+  A, infiniteA = splitDiagram(A)
+  B, infiniteB = splitDiagram(B)
+  if len(infiniteA) != len(infiniteB):
+    return np.inf
+  total = float(np.sum(np.abs(infiniteA - infiniteB) ** order))
+
+  costs = matchingCosts(A, B) ** order
+  if len(costs):
+    matching = linearAssignment(costs)
+    total += float(costs[np.arange(len(costs)), matching].sum())
+  return total ** (1.0 / order)
+
+# Distance between two diagrams by name, used by the worker processes of
+# distanceMatrix
+def diagramDistance(A, B, metric="bottleneck", order=2):
+  if metric == "bottleneck":
+    return bottleneck(A, B)
+  if metric == "wasserstein":
+    return wasserstein(A, B, order)
+  raise ValueError("unknown diagram distance: " + str(metric))
+
+# Symmetric N x N matrix of the distances between all pairs of a list of
+# diagrams, metric is "bottleneck" or "wasserstein" (of the given order). With
+# workers > 1 the pairs are shared out over a process pool
+def distanceMatrix(diagramList, metric="bottleneck", order=2, workers=1):
+  n = len(diagramList)
+  pairs = [(a, b) for a in range(n) for b in range(a+1, n)]
+  first = [diagramList[a] for a, b in pairs]
+  second = [diagramList[b] for a, b in pairs]
+  metrics = [metric]*len(pairs)
+  orders = [order]*len(pairs)
+
+  if workers > 1:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      distances = list(pool.map(diagramDistance, first, second, metrics, orders,
+                                chunksize=max(1, len(pairs) // (4*workers))))
+  else:
+    distances = list(map(diagramDistance, first, second, metrics, orders))
+
+  matrix = np.zeros((n, n))
+  for (a, b), distance in zip(pairs, distances):
+    matrix[a, b] = matrix[b, a] = distance
+  return matrix
+
+# Flatten a list of persistence diagrams (see splitDiagram) into the births,
+# deaths and diagram numbers of all their finite points. Infinite points are
+# left out, or given death infinity if it is not None
+def stackDiagrams(diagramList, infinity=None):
+  births = [np.empty(0)]
+  deaths = [np.empty(0)]
+  counts = []
+  for points in diagramList:
+    finite, infinite = splitDiagram(points)
+    births.append(finite[:, 0])
+    deaths.append(finite[:, 1])
+    if infinity is not None:
+      births.append(infinite)
+      deaths.append(np.full(len(infinite), float(infinity)))
+    counts.append(len(finite) + (len(infinite) if infinity is not None else 0))
+  ids = np.repeat(np.arange(len(diagramList)), counts)
+  return np.concatenate(births), np.concatenate(deaths), ids
+
+# Add the rows of values into out[ids], where ids is sorted: each run of equal
+# ids is summed with one np.add.reduceat
+def addRows(out, ids, values):
+  if len(ids):
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    out[ids[starts]] += np.add.reduceat(values, starts, axis=0)
+
+# Persistence images of a batch of diagrams (see splitDiagram), one row of the
+# returned (N, rx*ry) matrix per diagram. Each point (b, d) becomes the point
+# (b, d-b) in birth-persistence coordinates, weighted and spread by a Gaussian
+# of width sigma (by default one persistence pixel), then sampled at the centers
+# of an rx x ry grid over birthRange x persistenceRange (by default the range of
+# the whole batch, so that all rows are comparable). weight is "linear"
+# (persistence over the largest persistence), "constant", or a function of the
+# arrays of births and persistences. Every point of the batch is processed at
+# once, in chunks of chunkSize points to bound memory
+def persistenceImages(diagramList, resolution=(20, 20), sigma=None, weight="linear",
+                      birthRange=None, persistenceRange=None, infinity=None, chunkSize=4096):
+  births, deaths, ids = stackDiagrams(diagramList, infinity)
+  persistences = deaths - births
+  rx, ry = resolution
+
+  if birthRange is None:
+    birthRange = (births.min(), births.max()) if len(births) else (0.0, 1.0)
+  if persistenceRange is None:
+    persistenceRange = (0.0, persistences.max()) if len(births) else (0.0, 1.0)
+
+  # a range of a single value (the births of H0 diagrams of a Rips filtration
+  # are all 0) would make pixels of zero area: it is widened around the value,
+  # to pixels as wide as the persistence pixels
+  if persistenceRange[1] == persistenceRange[0]:
+    persistenceRange = (persistenceRange[0], persistenceRange[0] + 1.0)
+  if birthRange[1] == birthRange[0]:
+    half = (persistenceRange[1] - persistenceRange[0]) / ry * rx / 2
+    birthRange = (birthRange[0] - half, birthRange[0] + half)
+  xEdges = np.linspace(birthRange[0], birthRange[1], rx+1)
+  yEdges = np.linspace(persistenceRange[0], persistenceRange[1], ry+1)
+  xCenters = (xEdges[:-1] + xEdges[1:]) / 2
+  yCenters = (yEdges[:-1] + yEdges[1:]) / 2
+  area = (xEdges[1] - xEdges[0]) * (yEdges[1] - yEdges[0])
+  if sigma is None:
+    sigma = (yEdges[1] - yEdges[0]) or 1.0
+
+  if weight == "linear":
+    weights = persistences / (persistenceRange[1] or 1.0)
+  elif weight == "constant":
+    weights = np.ones(len(births))
+  elif callable(weight):
+    weights = np.asarray(weight(births, persistences), dtype=float)
+  else:
+    raise ValueError("unknown persistence image weight: " + str(weight))
+
+  # the Gaussian is separable, so each point is the outer product of a row and
+  # a column profile
+  images = np.zeros((len(diagramList), rx*ry))
+  scale = area * weights / (2*np.pi*sigma**2)
+  for start in range(0, len(births), chunkSize):
+    chunk = slice(start, start+chunkSize)
+    xProfile = np.exp(-(xCenters[None, :] - births[chunk, None])**2 / (2*sigma**2))
+    yProfile = np.exp(-(yCenters[None, :] - persistences[chunk, None])**2 / (2*sigma**2))
+    pixels = (scale[chunk, None] * xProfile)[:, :, None] * yProfile[:, None, :]
+    addRows(images, ids[chunk], pixels.reshape(len(pixels), rx*ry))
+
+  return images
+
+# Persistence landscapes of a batch of diagrams (see splitDiagram), one row of
+# the returned (N, numLandscapes*resolution) matrix per diagram. Landscape k at
+# t is the k-th largest of the tents max(0, min(t-b, d-t)) of the points (b, d),
+# sampled at resolution values of t evenly spaced over sampleRange (by default
+# from the smallest birth to the largest death of the whole batch). The
+# diagrams are padded to the same number of points and processed chunkSize
+# diagrams at a time
+def persistenceLandscapes(diagramList, numLandscapes=5, resolution=100, sampleRange=None,
+                          infinity=None, chunkSize=1024):
+  births, deaths, ids = stackDiagrams(diagramList, infinity)
+  if sampleRange is None:
+    sampleRange = (births.min(), deaths.max()) if len(births) else (0.0, 1.0)
+  samples = np.linspace(sampleRange[0], sampleRange[1], resolution)
+
+  # position of each point inside its diagram, to lay the points out in a
+  # (diagrams, points, samples) array
+  counts = np.bincount(ids, minlength=len(diagramList))
+  offsets = np.concatenate(([0], np.cumsum(counts)))
+  slots = np.arange(len(ids)) - offsets[ids]
+  width = max(int(counts.max()) if len(counts) else 0, numLandscapes)
+
+  landscapes = np.zeros((len(diagramList), numLandscapes, resolution))
+  for start in range(0, len(diagramList), chunkSize):
+    stop = min(start + chunkSize, len(diagramList))
+    points = slice(offsets[start], offsets[stop])
+    tents = np.zeros((stop - start, width, resolution))
+    tents[ids[points] - start, slots[points]] = np.maximum(0, np.minimum(
+      samples[None, :] - births[points, None], deaths[points, None] - samples[None, :]))
+    # the numLandscapes largest tents at each sample, largest first
+    top = -np.partition(-tents, numLandscapes-1, axis=1)[:, :numLandscapes]
+    landscapes[start:stop] = -np.sort(-top, axis=1)
+
+  return landscapes.reshape(len(diagramList), numLandscapes*resolution)
+
+# x (birth) and y (death) coordinates of the points of a persistence diagram,
+# either the points returned by persistence or an array returned by diagrams,
+# with limit in place of infinity
+def diagramCoordinates(points, limit=20):
+  if isinstance(points, np.ndarray):
+    return points["birth"].tolist(), np.where(points["infinite"], limit, points["death"]).tolist()
+
   x = []
   y = []
 
   # create a list of x values and a list of y values
   for p in points:
     x.append(p[0])
-    # use 20 in place of infinity
+    # use limit in place of infinity
     if p[1] == 'INF':
-      y.append(20)
+      y.append(limit)
     else:
       y.append(p[1])
 
+  return x, y
+
+# given a list of points, create a persistence diagram
+def plot(points):
+  # imported here so that importing this module does not load matplotlib
+  import matplotlib.pyplot as plt
+
+  # use 20 in place of infinity
+  x, y = diagramCoordinates(points, 20)
+
   # set up the axes
   plt.xlim(left = 0, right = 20)
   plt.ylim(bottom = 0, top = 20)
@@ -184,6 +1780,33 @@ def plot(points):
 
   plt.show()
 
+# Draw many persistence diagrams (see diagramCoordinates) to image files in one
+# pass, diagramList[k] goes to paths[k] and the format follows the extension.
+# The figures are drawn on the Agg canvas directly instead of through pyplot,
+# so no window is opened, nothing blocks and no figure is left open
+def renderDiagrams(diagramList, paths, limit=20, dpi=100):
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  from matplotlib.figure import Figure
+
+  if len(diagramList) != len(paths):
+    raise ValueError("renderDiagrams needs one path per diagram")
+
+  for points, path in zip(diagramList, paths):
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    x, y = diagramCoordinates(points, limit)
+
+    # same layout as plot
+    axes.set_xlim(left = 0, right = limit)
+    axes.set_ylim(bottom = 0, top = limit)
+    axes.set_xlabel("Birth")
+    axes.set_ylabel("Death")
+    axes.plot([0, limit], [0, limit])
+    axes.scatter(x, y)
+
+    figure.savefig(path, dpi = dpi)
+
 
 def main():
   # EXAMPLE 1, UNFILLED TRIANGLE
@@ -335,4 +1958,5 @@ def main():
   plot(p1)
   plot(p2)
 
-main()
+if __name__ == '__main__':
+  main()
@@ -1,69 +1,550 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
 from itertools import combinations
 import numpy as np
 from appJar import gui
+from PersistentHomology import SparseMatrix, SortedColumns
 
 
-class Simplex(object):
-     def __init__(self, name):
-          self.name = list(name)        # typecase the name so it split into the vertices
-          self.dim = len(name)-1        # the dimension is the number of vertices minus one
-          self.neighbors = []
-          self.wasVisited = False 
-     
-     def addNeighbor(self, s): 
-          if s not in self.neighbors: 
-               self.neighbors.append(s)
+class SimplexTable(object):
+     # simplices as sorted tuples of vertices in a table to their integer IDs, given
+     # in order of insertion
+     def __init__(self): 
+          self.ids = dict()             # sorted tuple of vertices -> ID
+          self.byId = []                # ID -> sorted tuple of vertices
+          self.values = []              # ID -> filtration value
+     
+     def __len__(self): 
+          return len(self.byId)
+     
+     def __contains__(self, s): 
+          return s in self.ids
+     
+     def __getitem__(self, s): 
+          return self.ids[s]
+     
+     def __iter__(self): 
+          return iter(self.byId)
+     
+     def add(self, s, value=0.0): 
+          self.ids[s] = len(self.byId)
+          self.byId.append(s)
+          self.values.append(value)
+          return self.ids[s]
+     
+     def addLevel(self, level, parents): 
+          # the rows of level as simplices in order; parents, the IDs of their faces
+          # without the last vertex, are only needed by the tree
+          for s in map(tuple, level.tolist()):
+               self.add(s)
+     
+     def simplex(self, i): 
+          return self.byId[i]
+     
+     def value(self, i): 
+          return self.values[i]
 
-class SimplicialComplex(object):
+class SimplexTree(object):
+     # a trie over sorted vertex sequences: a node is the simplex spelled by the
+     # labels on its path from the root, which is the empty simplex, and node numbers
+     # are IDs in order of insertion. Nodes live in flat arrays, so a simplex costs a
+     # few machine words instead of a tuple and a table entry. The children of a node
+     # are a run of kids, kept sorted by label so that a child is found by binary
+     # search; a run that is full moves to the end of kids with twice the room. The
+     # nodes with the same label and number of vertices form a cousin list, which is
+     # what coface queries walk. A vertex is the only node of its cousin list, so it
+     # is found directly
      def __init__(self): 
-          self.simplicies = dict()
+          self.vertices = dict()        # vertex -> label
+          self.names = []               # label -> vertex
+          self.label = array('q', [-1])
+          self.parent = array('q', [-1])
+          self.start = array('q', [0])  # where the run of children of each node starts in kids
+          self.count = array('i', [0])  # its number of children
+          self.room = array('i', [0])   # and its length
+          self.kids = array('q')        # runs of children, each sorted by label
+          self.cousin = array('q', [-1]) # next node of the same cousin list, or -1
+          self.values = array('d', [0.0])
+          self.cousins = dict()         # (number of vertices, label) -> first node of the cousin list
+     
+     def __len__(self): 
+          return len(self.label)
+     
+     def child(self, node, label): 
+          # the position in kids where the child of node with label is, or would go
+          a = self.start[node]
+          return bisect_left(self.kids, label, a, a + self.count[node], key=self.label.__getitem__)
+     
+     def children(self, node): 
+          a = self.start[node]
+          return self.kids[a:a + self.count[node]]
+     
+     def find(self, s): 
+          # walk down from the vertex s[0] one vertex at a time, -1 if s is not in the tree
+          if not s: return 0
+          if s[0] not in self.vertices: return -1
+          node = self.cousins.get((1, self.vertices[s[0]]), -1)
+          for v in s[1:]:
+               if v not in self.vertices: return -1
+               label = self.vertices[v]
+               k = self.child(node, label)
+               if k == self.start[node] + self.count[node] or self.label[self.kids[k]] != label: return -1
+               node = self.kids[k]
+          return node
+     
+     def __contains__(self, s): 
+          return self.find(s) != -1
+     
+     def __getitem__(self, s): 
+          node = self.find(s)
+          if node == -1: raise KeyError(s)
+          return node
+     
+     def __iter__(self): 
+          return (self.simplex(i) for i in range(len(self)))
+     
+     def newNode(self, label, parent, size, value): 
+          node = len(self)
+          self.label.append(label)
+          self.parent.append(parent)
+          self.start.append(0)
+          self.count.append(0)
+          self.room.append(0)
+          self.cousin.append(self.cousins.get((size, label), -1))
+          self.cousins[size, label] = node
+          self.values.append(value)
+          return node
+     
+     def attach(self, parent, node): 
+          # put node in the run of children of parent, in label order
+          a, c = self.start[parent], self.count[parent]
+          if c == self.room[parent]: 
+               room = max(2*c, 1)
+               if a + c == len(self.kids): 
+                    self.kids.extend([-1] * (room - c))
+               else: 
+                    kids = self.children(parent)
+                    self.start[parent] = a = len(self.kids)
+                    self.kids.extend(kids)
+                    self.kids.extend([-1] * (room - c))
+               self.room[parent] = room
+          k = self.child(parent, self.label[node])
+          self.kids[k+1:a+c+1] = self.kids[k:a+c]
+          self.kids[k] = node
+          self.count[parent] = c + 1
+     
+     def add(self, s, value=0.0): 
+          # the faces of s are added before it, so its parent is already there
+          if not s: return 0
+          parent = self[s[:-1]]
+          if s[-1] not in self.vertices: 
+               self.vertices[s[-1]] = len(self.names)
+               self.names.append(s[-1])
+          node = self.newNode(self.vertices[s[-1]], parent, len(s), value)
+          self.attach(parent, node)
+          return node
+     
+     def addLevel(self, level, parents): 
+          # the rows of level, sorted and with the same number of vertices, as new
+          # nodes under the IDs parents. The rows with the same parent are consecutive:
+          # a parent without children gets them as one new run, sorted by label, the
+          # others get them one at a time. Grouping the rows by last vertex gives the
+          # runs of the cousin lists
+          if not len(level): return
+          size = level.shape[1]
+          first = len(self)
+          for v in np.unique(level[:, -1]).tolist():
+               if v not in self.vertices: 
+                    self.vertices[v] = len(self.names)
+                    self.names.append(v)
+          labels = np.array([self.vertices[v] for v in level[:, -1].tolist()], dtype=np.int64)
+          parents = np.asarray(parents, dtype=np.int64)
+          ids = np.arange(first, first + len(level))
+          
+          order = np.argsort(labels, kind="stable")
+          cousin = np.full(len(level), -1, dtype=np.int64)
+          cousin[order[:-1]] = ids[order[1:]]
+          last = np.r_[np.flatnonzero(np.diff(labels[order])), len(level)-1]
+          head = np.r_[0, last[:-1] + 1]
+          for label, h, t in zip(labels[order[head]].tolist(), ids[order[head]].tolist(), order[last].tolist()):
+               cousin[t] = self.cousins.get((size, label), -1)
+               self.cousins[size, label] = h
+          
+          self.label.extend(labels.tolist())
+          self.parent.extend(parents.tolist())
+          self.start.extend([0] * len(level))
+          self.count.extend([0] * len(level))
+          self.room.extend([0] * len(level))
+          self.cousin.extend(cousin.tolist())
+          self.values.extend([0.0] * len(level))
+          
+          order = np.lexsort((labels, parents))
+          last = np.r_[np.flatnonzero(np.diff(parents[order])), len(level)-1]
+          head = np.r_[0, last[:-1] + 1]
+          kids = ids[order].tolist()
+          for p, h, t in zip(parents[order[head]].tolist(), head.tolist(), last.tolist()):
+               if self.count[p]: 
+                    for node in kids[h:t+1]: self.attach(p, node)
+               else: 
+                    self.start[p] = len(self.kids)
+                    self.count[p] = self.room[p] = t - h + 1
+                    self.kids.extend(kids[h:t+1])
+     
+     def simplex(self, i): 
+          s = []
+          while i > 0:
+               s.append(self.names[self.label[i]])
+               i = self.parent[i]
+          return tuple(reversed(s))
+     
+     def value(self, i): 
+          return self.values[i]
+     
+     def cofaceNodes(self, node, size): 
+          # the IDs of the cofaces of node, which has size vertices, in order. A coface
+          # with an extra vertex after the last one is a child of node, any other one
+          # ends with the same vertex as node, one level deeper, with node as a face
+          found = self.children(node).tolist()
+          if size: 
+               c = self.cousins.get((size+1, self.label[node]), -1)
+               while c != -1:
+                    if self.isCoface(c, node): found.append(c)
+                    c = self.cousin[c]
+          return sorted(found)
+     
+     def isCoface(self, c, node): 
+          # c, one level deeper than node with the same last label, has node as a face
+          # if dropping one of its labels gives the path of node
+          labels = []
+          while c > 0:
+               c = self.parent[c]
+               labels.append(self.label[c])
+          skipped = False
+          node = self.parent[node]
+          for label in labels[:-1]:
+               if node > 0 and self.label[node] == label: node = self.parent[node]
+               elif skipped: return False
+               else: skipped = True
+          return node == 0
+     
+     def cofaces(self, s): 
+          return [self.simplex(c) for c in self.cofaceNodes(self[s], len(s))]
+
+class SimplicialComplex(object):
+     # a simplex is stored as the sorted tuple of its vertices in a backend, a
+     # SimplexTable or a SimplexTree, that gives it an integer ID in order of
+     # insertion. Faces are found by dropping one vertex, there are no per-simplex
+     # objects
+     def __init__(self, backend=SimplexTable): 
+          self.simplicies = backend()
           self.highest = 0
+          self.boundary = None          # facet columns in filtration order as CSC offsets and rows, if known (see fromArray)
+          
+          self.index = None             # indexes for local queries, if built (see indexes)
+          self.insert(()) # add empty simplex 
+     
+     # bulk construction from an (M, k+1) integer array of maximal simplices
+     @classmethod
+     def fromArray(cls, maximal, backend=SimplexTable):
+          maximal = np.sort(np.asarray(maximal, dtype=np.int64), axis=1)
+          n = maximal.shape[1]
+          sc = cls(backend)
+          
+          # a face is encoded as one integer, the rank of its first vertices among the
+          # faces one dimension down times (largest vertex + 1), plus its last vertex.
+          # That keeps the lexicographic order and fits in 64 bits, and sorting and
+          # searching integers is much faster than sorting rows
+          base = int(maximal.max()) + 1 if maximal.size else 1
+          keys = []
+          def encode(rows):
+               code = rows[:, 0]
+               for k in range(1, rows.shape[1]):
+                    code = np.searchsorted(keys[k-1], code) * base + rows[:, k]
+               return code
+          
+          # the faces with size vertices are the rows of maximal restricted to every
+          # choice of size of its columns, which keeps them sorted; np.unique keeps
+          # one copy of each, in lexicographic order
+          levels = []
+          for size in range(1, n+1):
+               index = np.array(list(combinations(range(n), size)))
+               faces = maximal[:, index].reshape(-1, size)
+               code, first = np.unique(encode(faces), return_index=True)
+               levels.append(faces[first])
+               keys.append(code)
+          
+          # the facets of one dimension are found among the faces of the dimension
+          # below by binary search on their codes. The columns are kept in CSC form,
+          # the rows of column j are rows[offsets[j]:offsets[j+1]]
+          rows = []
+          counts = [np.zeros(len(levels[0]), dtype=np.int64)]
+          offset = 0
+          for p in range(1, n):
+               index = np.array([[v for v in range(p+1) if v != k] for k in range(p+1)])
+               facets = levels[p][:, index].reshape(-1, p)
+               rows.append(np.searchsorted(keys[p-1], encode(facets)) + offset)
+               counts.append(np.full(len(levels[p]), p+1, dtype=np.int64))
+               offset += len(levels[p-1])
+          offsets = np.r_[0, np.cumsum(np.concatenate(counts))]
+          rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+          
+          # the simplices go to the backend one level at a time, with the IDs of their
+          # faces without the last vertex found the same way as the facets
+          previous = 0
+          for size, level in enumerate(levels, 1):
+               first = len(sc.simplicies)
+               if size == 1: parents = np.zeros(len(level), dtype=np.int64)
+               else: parents = np.searchsorted(keys[size-2], encode(level[:, :-1])) + previous
+               sc.simplicies.addLevel(level, parents)
+               previous = first
+          sc.highest = n-1
+          sc.boundary = (offsets, rows)
+          return sc
      
      def __str__(self): 
           ans = ""
           for i in self.simplicies:
-               ans += i + ", "
+               ans += self.label(i) + ", "
           return ans
      
-     def getS(self, name): 
-          # if this is a new node, add it to the grapph
-          if name not in self.simplicies: self.simplicies[name] = Simplex(name)
+     def __len__(self): 
+          return len(self.simplicies)
+     
+     def __contains__(self, name): 
+          return self.canonical(name) in self.simplicies
+     
+     def canonical(self, name): 
+          # a string is a simplex of one-character vertices, anything else (a list, a
+          # tuple, a NumPy array) a sequence of vertices, integer IDs or characters
+          return tuple(sorted(v if isinstance(v, str) else int(v) for v in name))
+     
+     def label(self, s): 
+          # print one-character vertices the way they were entered
+          if all(isinstance(v, str) for v in s): return ''.join(s)
+          return str(s)
+     
+     def getS(self, name, value=0.0): 
+          s = self.canonical(name)
+          
+          # if this is a new node, add it to the grapph and give it the next ID
+          if s not in self.simplicies: self.insert(s, value)
+          return self.simplicies[s] 
+     
+     def insert(self, s, value=0.0): 
+          # add a new simplex, a sorted tuple of vertices, to the backend; the boundary
+          # cache and the indexes no longer hold and are dropped
+          i = self.simplicies.add(s, value)
+          self.boundary = None
+          self.index = None
           
           #keep track of the highest dimension seen so far in the graph
-          if self.simplicies[name].dim > self.highest: self.highest = self.simplicies[name].dim
-          return self.simplicies[name] 
-     
-     
-     def addEdge(self, name):
-          self.getS("") # add empty string 
-          x = [''.join(l) for i in range(len(name)) for l in combinations(name, i+1)] # all combinations of the simplex
-          for i in x:
-               self.getS(i)          
-          for i in x:
-               for j in x:
-                    # if the simplicies are contained (in any combination) to another simplex
-                    # and the simplicies are immeidately following dimensions 
-                    # then make the two simplicies neighbors
-                    if 0 not in [c in j for c in i] \
-                       and self.simplicies[i].dim == self.simplicies[j].dim-1: 
-                         self.simplicies[i].addNeighbor(self.simplicies[j])
-                         self.simplicies[j].addNeighbor(self.simplicies[i]) 
-                         
-                    # if the simplicies has degree 0, make the empty simplex a neighbor
-                    if self.simplicies[i].dim == 0: self.simplicies[i].addNeighbor(self.getS(""))
+          if len(s)-1 > self.highest: self.highest = len(s)-1
+          return i
+     
+     def faces(self, s): 
+          # the facets of a simplex, by dropping one vertex at a time
+          return [s[:k] + s[k+1:] for k in range(len(s))]
+     
+     def indexes(self): 
+          # the indexes for local queries, built on first use after an insert, as
+          # integer arrays rather than lists so that they cost a few bytes per entry:
+          #   dimensions   p -> IDs of the simplices with p vertices, in order
+          #   vertices     v -> k, the position of vertex v
+          #   offsets      the simplices that contain vertex v are incidence[offsets[k]:offsets[k+1]],
+          #   incidence    by number of vertices, then ID
+          #   sizes        ID -> number of vertices
+          if self.index is None: 
+               vertices = dict()
+               owners = array('q')
+               positions = array('q')
+               for i, s in enumerate(self.simplicies):
+                    for v in s:
+                         owners.append(i)
+                         positions.append(vertices.setdefault(v, len(vertices)))
+               owners = np.frombuffer(owners, dtype=np.int64)
+               positions = np.frombuffer(positions, dtype=np.int64)
+               sizes = np.bincount(owners, minlength=len(self.simplicies))
+               
+               # a stable sort of the IDs by size keeps each dimension in ID order, and
+               # sorting the incidences by vertex, size and ID groups them by vertex
+               ids = np.argsort(sizes, kind="stable")
+               dimensions = np.split(ids, np.cumsum(np.bincount(sizes))[:-1])
+               incidence = owners[np.lexsort((owners, sizes[owners], positions))]
+               offsets = np.searchsorted(np.sort(positions), np.arange(len(vertices)+1))
+               self.index = (dimensions, vertices, offsets, incidence, sizes)
+          return self.index
+     
+     def containing(self, s, sizes): 
+          # the simplices with a number of vertices in sizes that contain s. A tree finds
+          # them one level up at a time along its coface lists (see SimplexTree), the
+          # table among those of the vertex of s that is in the fewest simplices
+          if hasattr(self.simplicies, "cofaceNodes"): 
+               if s not in self.simplicies: return []
+               level = [self.simplicies[s]]
+               found = []
+               for p in range(len(s), max(sizes, default=0) + 1):
+                    if not level: break
+                    if p in sizes: found.extend(level)
+                    level = sorted({c for node in level for c in self.simplicies.cofaceNodes(node, p)})
+               return [self.simplicies.simplex(i) for i in found]
+          
+          dimensions, vertices, offsets, incidence, size = self.indexes()
+          if not s: 
+               return [self.simplicies.simplex(i) for p in sizes if p < len(dimensions) for i in dimensions[p].tolist()]
+          if any(v not in vertices for v in s): return []
+          k = min((vertices[v] for v in s), key=lambda k: offsets[k+1] - offsets[k])
+          ids = incidence[offsets[k]:offsets[k+1]]
+          bounds = np.searchsorted(size[ids], [(p, p+1) for p in sizes])
+          found = []
+          for a, b in bounds.tolist():
+               for i in ids[a:b].tolist():
+                    t = self.simplicies.simplex(i)
+                    if len(s) == 1 or set(s).issubset(t): found.append(t)
+          return found
+     
+     def cofaces(self, name): 
+          # the simplices one dimension up that contain the simplex
+          s = self.canonical(name)
+          return self.containing(s, [len(s)+1])
+     
+     def star(self, name): 
+          # the simplices that contain the simplex, itself included
+          s = self.canonical(name)
+          return self.containing(s, range(len(s), self.highest+2))
+     
+     def link(self, name): 
+          # the nonempty simplices disjoint from the simplex whose union with it is in
+          # the complex
+          s = self.canonical(name)
+          return [tuple(v for v in t if v not in s) for t in self.star(s) if len(t) > len(s)]
+     
+     def closure(self, names): 
+          # the simplices and all their faces, each face once
+          seen = set()
+          found = []
+          new = [self.canonical(name) for name in names]
+          while new:
+               s = new.pop()
+               if s in seen: continue
+               seen.add(s)
+               found.append(s)
+               new.extend(self.faces(s))
+          return found
+     
+     def isFace(self, s, t): 
+          return len(s) == len(t)-1 and set(s).issubset(t)
+     
+     def value(self, name): 
+          return self.simplicies.value(self.simplicies[self.canonical(name)])
+     
+     def addEdge(self, name, value=0.0):
+          # a simplex that is already in the complex already has all its faces
+          top = self.canonical(name)
+          if top in self.simplicies: return
+          
+          # walk down from the simplex to its faces: the facets of a face are found by
+          # dropping one vertex, and only faces that are new get expanded, so the work
+          # is proportional to the number of new faces
+          new = [top]
+          seen = {top}
+          for s in new:
+               if len(s) == 1: continue
+               for f in self.faces(s):
+                    if f not in self.simplicies and f not in seen: 
+                         seen.add(f)
+                         new.append(f)
+          
+          # then add them faces first, each dimension in lexicographic order (the
+          # order of combinations), with the filtration value of the simplex
+          for s in sorted(new, key=lambda s: (len(s), s)): self.getS(s, value)
+     
+     def filtration(self):
+          # the simplices in filtration order: by dimension, and by filtration value
+          # then order of insertion within a dimension, leaving out the empty simplex
+          values = np.asarray(self.simplicies.values, dtype=float)
+          levels = [level[np.argsort(values[level], kind="stable")] for level in self.indexes()[0][1:]]
+          return [self.simplicies.simplex(i) for level in levels for i in level.tolist()]
+     
+     def collapse(self, filtration=False):
+          # a smaller complex with the same homology, by elementary collapses: a
+          # simplex with a single coface (its free face) is removed together with that
+          # coface, as long as there are any. With filtration=True a pair is only
+          # removed if both have the same filtration value, which keeps the persistence
+          # diagrams but for pairs of zero persistence. The number of pairs removed is
+          # left in collapsed of the result
+          simplex = self.simplicies.simplex
+          facets = lambda i: [self.simplicies[f] for f in self.faces(simplex(i))]
+          
+          # for each simplex, the number of its cofaces still in the complex and the
+          # xor of their IDs, which is the ID of the coface when there is just one
+          alive = [True]*len(self.simplicies)
+          count = [0]*len(self.simplicies)
+          cofaces = [0]*len(self.simplicies)
+          for i in range(len(self.simplicies)):
+               if len(simplex(i)) < 2: continue
+               for f in facets(i):
+                    count[f] += 1
+                    cofaces[f] ^= i
+          
+          # the work queue holds the candidate free faces, the empty simplex never is one
+          queue = deque(i for i in range(len(self.simplicies)) if count[i] == 1 and simplex(i))
+          pairs = 0
+          while queue:
+               i = queue.popleft()
+               if not alive[i] or count[i] != 1: continue
+               j = cofaces[i]
+               if filtration and self.simplicies.value(i) != self.simplicies.value(j): continue
+               
+               # remove the pair, the faces of both lose a coface
+               alive[i] = alive[j] = False
+               pairs += 1
+               for k in (j, i):
+                    if len(simplex(k)) < 2: continue
+                    for f in facets(k):
+                         count[f] -= 1
+                         cofaces[f] ^= k
+                         if count[f] == 1 and alive[f] and simplex(f): queue.append(f)
+          
+          # the simplices that are left, in the same order and with the same values
+          collapsed = SimplicialComplex(type(self.simplicies))
+          for i in range(1, len(self.simplicies)):
+               if alive[i]: collapsed.insert(simplex(i), self.simplicies.value(i))
+          collapsed.collapsed = pairs
+          return collapsed
+     
+     def boundaryMatrix(self, backend=SortedColumns):
+          # the boundary matrix in filtration order, ready for REDUCE, with the
+          # simplices dimension ranges computeBetti and persistence expect. It is built
+          # from the facets of each simplex, in time linear in the number of incidences
+          order = self.filtration()
+          if self.boundary is not None:
+               offsets, rows = self.boundary
+               columns = [rows[offsets[j]:offsets[j+1]].tolist() for j in range(len(order))]
+          else:
+               position = {s: j for j, s in enumerate(order)}
+               columns = [[position[f] for f in self.faces(s)] if len(s) > 1 else [] for s in order]
+          
+          simplices = []
+          start = 0
+          for j in range(1, len(order)+1):
+               if j == len(order) or len(order[j]) != len(order[start]):
+                    simplices.append((start, j-1))
+                    start = j
+          return SparseMatrix(columns, backend=backend), simplices
      
      def matrix(self):
           for p in range(self.highest,-1,-1):
                row = []
                col = []               
                for i in self.simplicies:
-                    if self.simplicies[i].dim == p-1: 
+                    if len(i)-1 == p-1: 
                          row.append(i)
-                    if self.simplicies[i].dim == p:  
+                    if len(i)-1 == p:  
                          col.append(i)
                print("Dimension ", p, "-", p-1, ":")
-               print("Rows: ", row)
-               print("Cols: ", col)
+               print("Rows: ", [self.label(i) for i in row])
+               print("Cols: ", [self.label(i) for i in col])
                self.matrixPopulation(row,col)
           print("Complete Boundary Matrix:")
           self.matrixPopulation(self.simplicies,self.simplicies)
@@ -78,7 +559,9 @@ class SimplicialComplex(object):
                c = -1
                for j in col:
                     c +=1
-                    if self.simplicies[i] in self.simplicies[j].neighbors:
+                    # a simplex neighbors its facets and its cofaces, but the empty
+                    # simplex has no neighbors of its own
+                    if self.isFace(i, j) or (j and self.isFace(j, i)):
                          matrix[r][c] = 1
                print(matrix[r])
           